@@ -0,0 +1,620 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Precomputed aggregates for the dashboard callbacks
+#
+# Every time a widget changed, the bar plot and the heatmap used to go back to the raw dataframe and run a fresh
+# groupby / pivot_table over every registered vehicle. The numbers they show only ever depend on three things:
+# the `Model Year`, the `EV Regional Origin` and the `County` of each vehicle. So instead, we count every
+# (year, origin, county) combination once when the data is loaded and store the counts in a small 3D numpy array (the "cube").
+#
+# Along the year axis we also keep a cumulative sum, so the count for any `year_range` is just two slices subtracted
+# from each other: `prefix[hi + 1] - prefix[lo]`. The callbacks never touch the raw rows again.
+
+import io
+
+import numpy as np
+import pandas as pd
+
+
+## Name of the county slot that collects every row outside of WA (or with no county), so the bar plot still counts them
+OTHER_COUNTY = '__other__'
+
+## Width (in Web Mercator metres) of the square cells the map counts vehicles in
+MAP_CELL_METERS = 2000
+EARTH_RADIUS = 6378137.0
+
+
+def build_count_cube(frame, year_col='Model Year', origin_col='EV Regional Origin', county_col='County',
+                     state_col='State', count_col='VIN (1-10)', state='WA'):
+    columns = (year_col, origin_col, county_col, state_col, state)
+
+    ## Rows without a model year can never show up in a groupby on 'Model Year', so they are left out here as well
+    frame = frame[frame[year_col].notna()]
+    year_labels, origin_labels, county_labels = _cube_labels(frame, *columns)
+
+    shape = (len(year_labels), len(origin_labels), len(county_labels))
+    flat_idx = _cube_index(frame, year_labels, origin_labels, county_labels, *columns)
+    size = int(np.prod(shape))
+
+    ## `count` in pandas skips missing values, while every row still creates its group. We keep both numbers
+    counts = np.bincount(flat_idx, weights=frame[count_col].notna().to_numpy(), minlength=size)
+    rows = np.bincount(flat_idx, minlength=size)
+
+    ## Position of the first row of each combination, used to reproduce the order pivot_table(sort=False) puts things in
+    first_row = np.full(size, np.iinfo(np.int64).max, dtype=np.int64)
+    np.minimum.at(first_row, flat_idx, np.arange(len(flat_idx), dtype=np.int64))
+
+    counts = counts.astype(np.int64).reshape(shape)
+    rows = rows.astype(np.int64).reshape(shape)
+
+    return {
+        'years': year_labels,
+        'origins': origin_labels,
+        'counties': county_labels,
+        'count_prefix': _prefix_sum(counts),
+        'row_prefix': _prefix_sum(rows),
+        'first_row': first_row.reshape(shape),
+        ## Position the next row added by `update_count_cube` gets, so it always counts as appearing after every other row
+        'next_row': len(flat_idx),
+    }
+
+
+def _cube_labels(frame, year_col, origin_col, county_col, state_col, state):
+    years = frame[year_col].to_numpy().astype(np.int64)
+    year_labels = np.arange(years.min(), years.max() + 1) if len(years) else np.arange(0)
+    origin_labels = sorted(frame[origin_col].dropna().unique())
+
+    ## Only WA counties get their own slot, everything else goes into the trailing "other" slot
+    in_state = (frame[state_col] == state).to_numpy() & frame[county_col].notna().to_numpy()
+    county_labels = sorted(frame.loc[in_state, county_col].unique()) + [OTHER_COUNTY]
+    return year_labels, origin_labels, county_labels
+
+
+def _cube_index(frame, year_labels, origin_labels, county_labels, year_col, origin_col, county_col, state_col, state):
+    ## Flat position in the cube of every row. Every year, origin and county in `frame` has to be on the cube's axes
+    if len(frame) == 0:
+        return np.zeros(0, dtype=np.int64)
+    years = frame[year_col].to_numpy().astype(np.int64)
+    origin_idx = pd.Categorical(frame[origin_col], categories=origin_labels).codes.astype(np.int64)
+
+    in_state = (frame[state_col] == state).to_numpy() & frame[county_col].notna().to_numpy()
+    county_idx = pd.Categorical(frame[county_col], categories=county_labels[:-1]).codes.astype(np.int64)
+    county_idx[~in_state] = len(county_labels) - 1
+
+    shape = (len(year_labels), len(origin_labels), len(county_labels))
+    return np.ravel_multi_index((years - year_labels[0], origin_idx, county_idx), shape)
+
+
+def _prefix_sum(counts):
+    ## A leading block of zeros means the sum of years [lo, hi] is always prefix[hi + 1] - prefix[lo]
+    prefix = np.zeros((counts.shape[0] + 1,) + counts.shape[1:], dtype=np.int64)
+    np.cumsum(counts, axis=0, out=prefix[1:])
+    return prefix
+
+
+def _year_slice(cube, year_range):
+    ## Turn a (start, end) widget value into positions on the year axis, clipped to the years we actually have
+    years = cube['years']
+    if len(years) == 0:
+        return 0, 0
+    lo = int(np.clip(np.ceil(year_range[0]) - years[0], 0, len(years)))
+    hi = int(np.clip(np.floor(year_range[1]) - years[0] + 1, lo, len(years)))
+    return lo, hi
+
+
+def _origin_positions(cube, ev_origin):
+    if ev_origin == 'All':
+        return slice(None)
+    return [i for i, origin in enumerate(cube['origins']) if origin == ev_origin]
+
+
+def cube_year_totals(cube):
+    ## Number of vehicles per model year over every origin and county, i.e. the old global `maxy` groupby
+    totals = np.diff(cube['count_prefix'].sum(axis=(1, 2)))
+    return pd.Series(totals, index=pd.Index(cube['years'], name='Model Year'))
+
+
+def cube_year_counts(cube, ev_origin):
+    ## Same result as `df[df['EV Regional Origin'] == ev_origin].groupby('Model Year')['VIN (1-10)'].count()`
+    origins = _origin_positions(cube, ev_origin)
+    counts = np.diff(cube['count_prefix'][:, origins, :].sum(axis=(1, 2)))
+    rows = np.diff(cube['row_prefix'][:, origins, :].sum(axis=(1, 2)))
+
+    present = rows > 0
+    return pd.DataFrame({
+        'Model Year': cube['years'][present],
+        'Number of EVs': counts[present],
+    })
+
+
+def cube_county_origin_counts(cube, year_range, counties):
+    ## Same result as the pivot_table in `create_heatmap`, for the given counties and an inclusive `year_range`
+    lo, hi = _year_slice(cube, year_range)
+    county_pos = [cube['counties'].index(county) for county in counties if county in cube['counties']]
+
+    counts = cube['count_prefix'][hi][:, county_pos] - cube['count_prefix'][lo][:, county_pos]
+    rows = cube['row_prefix'][hi][:, county_pos] - cube['row_prefix'][lo][:, county_pos]
+    first_row = cube['first_row'][lo:hi][:, :, county_pos].min(axis=0, initial=np.iinfo(np.int64).max)
+
+    ## pivot_table(sort=False) lists counties and origins in the order they first appear in the filtered rows,
+    ## and leaves out any that have no rows at all
+    origin_first = first_row.min(axis=1)
+    county_first = first_row.min(axis=0)
+    origin_order = [i for i in np.argsort(origin_first, kind='stable') if rows[i].sum() > 0]
+    county_order = [j for j in np.argsort(county_first, kind='stable') if rows[:, j].sum() > 0]
+
+    return pd.DataFrame(
+        counts[np.ix_(origin_order, county_order)].T,
+        index=pd.Index([cube['counties'][county_pos[j]] for j in county_order], name='County'),
+        columns=pd.Index([cube['origins'][i] for i in origin_order], name='EV Regional Origin'),
+    )
+
+
+def cube_top_counties(cube, n=10):
+    ## Same result as the WA `groupby('County').agg({'VIN (1-10)': 'count'}).nlargest(n, 'VIN (1-10)')`, as a two column frame.
+    ## Counties are sorted by name on the cube's axis, so a stable sort keeps ties in the order nlargest keeps them
+    counts = cube['count_prefix'][-1].sum(axis=0)[:-1]
+    rows = cube['row_prefix'][-1].sum(axis=0)[:-1]
+    present = np.flatnonzero(rows > 0)
+    top = present[np.argsort(-counts[present], kind='stable')[:n]]
+    return pd.DataFrame({
+        'County': [cube['counties'][j] for j in top],
+        'VIN (1-10)': counts[top],
+    })
+
+
+# ## Density grid for the dot plot
+#
+# With every vehicle drawn as its own dot, the dot plot sends one point per vehicle to the browser. Binning the
+# `Jitter` x `Electric Range` plane into a fixed grid of pixels on the server keeps what gets sent bounded by the
+# size of the grid instead. Vehicles that sit in nearly empty pixels are the outliers we still want to see as
+# individual dots, so those rows are picked out separately.
+
+def density_grid(x, y, x_range, y_range, width, height, min_count=1):
+    ## Counts the rows in every pixel of a width x height grid. Returns the counts as an image array (the first row is
+    ## the top of the plot) and a mask of the rows sitting in a pixel with fewer than `min_count` rows, which also
+    ## includes any row that falls outside of the ranges
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    x_range = (float(x_range[0]), float(x_range[1]))
+    y_range = (float(y_range[0]), float(y_range[1]))
+    col = np.floor((x - x_range[0]) / (x_range[1] - x_range[0]) * width).astype(np.int64)
+    row = np.floor((y - y_range[0]) / (y_range[1] - y_range[0]) * height).astype(np.int64)
+
+    ## A value sitting exactly on the upper edge belongs to the last pixel, the same way np.histogram does it
+    col[x == x_range[1]] = width - 1
+    row[y == y_range[1]] = height - 1
+
+    inside = (col >= 0) & (col < width) & (row >= 0) & (row < height)
+    counts = np.bincount(row[inside] * width + col[inside], minlength=width * height).reshape(height, width)
+
+    sparse = ~inside
+    sparse[inside] = counts[row[inside], col[inside]] < min_count
+    return counts[::-1], sparse
+
+
+# ## Range histograms for the violin plot
+#
+# The violin plot used to hand every vehicle in the selected years to hvplot, which then worked out a KDE for each
+# origin from scratch. Here the `Electric Range` of every vehicle is counted once into fixed bins per
+# (Model Year, origin), again with a cumulative sum along the year axis. Any `year_range` is answered by subtracting two
+# slices, and the violin shape, quartiles and whiskers are all worked out from those summed bins. Electric ranges are
+# whole miles, so with the default 1 mile bins every bin holds a single exact value and nothing is lost by binning.
+
+def build_range_histograms(frame, bin_width=1, year_col='Model Year', origin_col='EV Regional Origin',
+                           value_col='Electric Range'):
+    frame = frame[frame[year_col].notna() & frame[value_col].notna()]
+
+    years = frame[year_col].to_numpy().astype(np.int64)
+    year_min = int(years.min()) if len(years) else 0
+    year_max = int(years.max()) if len(years) else -1
+    year_labels = np.arange(year_min, year_max + 1)
+
+    ## Origins in alphabetical order, which is also the order the violins are drawn in (the order hvplot drew them in)
+    origin_labels = sorted(frame[origin_col].dropna().unique())
+    origin_idx = pd.Categorical(frame[origin_col], categories=origin_labels).codes.astype(np.int64)
+
+    values = frame[value_col].to_numpy(dtype=np.int64)
+    value_min = int(values.min()) if len(values) else 0
+    bin_idx = (values - value_min) // bin_width
+    n_bins = int(bin_idx.max()) + 1 if len(values) else 0
+
+    shape = (len(year_labels), len(origin_labels), n_bins)
+    counts = np.bincount(np.ravel_multi_index((years - year_min, origin_idx, bin_idx), shape),
+                         minlength=int(np.prod(shape))).reshape(shape)
+
+    ## Each bin holds the whole numbers [edge, edge + bin_width), so its middle one stands in for the values in it
+    return {
+        'years': year_labels,
+        'origins': origin_labels,
+        'values': value_min + np.arange(n_bins) * bin_width + (bin_width - 1) / 2,
+        'bin_width': bin_width,
+        'count_prefix': _prefix_sum(counts),
+    }
+
+
+def histogram_counts(histograms, year_range):
+    ## Counts per (origin, bin) for an inclusive `year_range`
+    lo, hi = _year_slice(histograms, year_range)
+    return histograms['count_prefix'][hi] - histograms['count_prefix'][lo]
+
+
+def histogram_percentile(values, counts, q):
+    ## Same as np.percentile (linear interpolation) on the values the counts stand for, without expanding them
+    total = counts.sum()
+    rank = (total - 1) * q / 100
+    cumulative = np.cumsum(counts)
+    below = values[np.searchsorted(cumulative, np.floor(rank), side='right')]
+    above = values[np.searchsorted(cumulative, np.ceil(rank), side='right')]
+    return below + (above - below) * (rank - np.floor(rank))
+
+
+def histogram_kde(values, counts, n_samples=100, cut=5):
+    ## Gaussian KDE with Scott's bandwidth, the way HoloViews draws a violin, but summed over bins instead of rows:
+    ## every bin adds one kernel weighted by its count. Returns the points the density was evaluated at and the density,
+    ## or (None, None) when every vehicle has the same range, which leaves nothing to smooth (HoloViews draws no KDE then)
+    present = counts > 0
+    values, counts = values[present], counts[present]
+    total = counts.sum()
+    mean = (values * counts).sum() / total
+    std = np.sqrt((counts * (values - mean) ** 2).sum() / (total - 1))
+    bandwidth = total ** (-1 / 5) * std
+    if bandwidth == 0:
+        return None, None
+
+    support = np.linspace(values[0] - cut * bandwidth, values[-1] + cut * bandwidth, n_samples)
+    kernels = np.exp(-0.5 * ((support[:, None] - values[None, :]) / bandwidth) ** 2)
+    density = kernels @ counts / (total * bandwidth * np.sqrt(2 * np.pi))
+    return support, density
+
+
+def histogram_violins(histograms, year_range, n_samples=100, cut=5):
+    ## Everything needed to draw one violin per origin for the given `year_range`: the KDE outline plus the
+    ## quartiles and whiskers of the inner box, with the same 1.5 x IQR rule HoloViews uses
+    counts = histogram_counts(histograms, year_range)
+    values = histograms['values']
+
+    violins = {}
+    for origin, origin_counts in zip(histograms['origins'], counts):
+        if origin_counts.sum() < 2:
+            continue
+        support, density = histogram_kde(values, origin_counts, n_samples, cut)
+        q1, q2, q3 = (histogram_percentile(values, origin_counts, q) for q in (25, 50, 75))
+        present = values[origin_counts > 0]
+        iqr = q3 - q1
+        violins[origin] = {
+            'support': support,
+            'density': density,
+            'q1': q1,
+            'q2': q2,
+            'q3': q3,
+            'lower': min(present[present >= q1 - 1.5 * iqr].min(), q1),
+            'upper': max(present[present <= q3 + 1.5 * iqr].max(), q3),
+            'count': int(origin_counts.sum()),
+        }
+    return violins
+
+
+def violin_accuracy(frame, histograms, year_range, year_col='Model Year', origin_col='EV Regional Origin',
+                    value_col='Electric Range', n_samples=100, cut=5):
+    ## Compares `histogram_violins` with a KDE worked out from the raw rows the same way HoloViews does it
+    ## (scipy's gaussian_kde evaluated on the same points), so the error of the binned version can be checked
+    from scipy import stats
+
+    rows = frame[(frame[year_col] >= year_range[0]) & (frame[year_col] <= year_range[1])]
+    report = []
+    for origin, violin in histogram_violins(histograms, year_range, n_samples, cut).items():
+        if violin['density'] is None:
+            continue
+        samples = rows.loc[rows[origin_col] == origin, value_col].to_numpy(dtype=float)
+        raw_density = stats.gaussian_kde(samples).evaluate(violin['support'])
+        q1, q2, q3 = np.percentile(samples, [25, 50, 75])
+        report.append({
+            'EV Regional Origin': origin,
+            'vehicles': len(samples),
+            'max density error (% of peak)': 100 * np.abs(violin['density'] - raw_density).max() / raw_density.max(),
+            'quartile error (mi)': max(abs(violin['q1'] - q1), abs(violin['q2'] - q2), abs(violin['q3'] - q3)),
+        })
+    return pd.DataFrame(report)
+
+
+# ## Patching the aggregates with a delta
+#
+# When the DOL publishes its monthly update, only a small share of the vehicles is new, changed or deregistered.
+# Instead of building the cube and the histograms again from every row, the rows that went away (and the old version of
+# every changed row) are taken out of the counts and the new rows are added in. The axes only grow, when a new model
+# year, origin, county or range shows up, so the work depends on the size of the delta and of the (small) arrays.
+#
+# Removed rows keep their `first_row` entry, so the order the heatmap lists counties and origins in stays the same
+# from one update to the next instead of jumping around.
+
+def _reindex(array, old_axes, new_axes, fill=0):
+    ## Lay `array` out along bigger axes (every old label is still on its new axis), with `fill` in the new slots
+    out = np.full(tuple(len(axis) for axis in new_axes), fill, dtype=array.dtype)
+    positions = [pd.Index(new).get_indexer(old) for old, new in zip(old_axes, new_axes)]
+    out[np.ix_(*positions)] = array
+    return out
+
+
+def _merged_years(years, more_years):
+    years = np.concatenate([years, more_years])
+    return np.arange(years.min(), years.max() + 1) if len(years) else years
+
+
+def update_count_cube(cube, removed, added, year_col='Model Year', origin_col='EV Regional Origin', county_col='County',
+                      state_col='State', count_col='VIN (1-10)', state='WA'):
+    ## A new cube with the `removed` rows taken out and the `added` rows counted in. Updating a vehicle means passing
+    ## its old row in `removed` and its new row in `added`
+    columns = (year_col, origin_col, county_col, state_col, state)
+    removed = removed[removed[year_col].notna()]
+    added = added[added[year_col].notna()]
+
+    added_years, added_origins, added_counties = _cube_labels(added, *columns)
+    old_axes = [cube['years'], cube['origins'], cube['counties']]
+    new_axes = [
+        _merged_years(cube['years'], added_years),
+        sorted(set(cube['origins']) | set(added_origins)),
+        sorted(set(cube['counties'][:-1]) | set(added_counties[:-1])) + [OTHER_COUNTY],
+    ]
+
+    counts = _reindex(np.diff(cube['count_prefix'], axis=0), old_axes, new_axes)
+    rows = _reindex(np.diff(cube['row_prefix'], axis=0), old_axes, new_axes)
+    first_row = _reindex(cube['first_row'], old_axes, new_axes, fill=np.iinfo(np.int64).max)
+
+    removed_idx = _cube_index(removed, *new_axes, *columns)
+    np.subtract.at(counts.reshape(-1), removed_idx, removed[count_col].notna().to_numpy().astype(np.int64))
+    np.subtract.at(rows.reshape(-1), removed_idx, 1)
+
+    added_idx = _cube_index(added, *new_axes, *columns)
+    np.add.at(counts.reshape(-1), added_idx, added[count_col].notna().to_numpy().astype(np.int64))
+    np.add.at(rows.reshape(-1), added_idx, 1)
+    np.minimum.at(first_row.reshape(-1), added_idx, cube['next_row'] + np.arange(len(added_idx), dtype=np.int64))
+
+    return {
+        'years': new_axes[0],
+        'origins': new_axes[1],
+        'counties': new_axes[2],
+        'count_prefix': _prefix_sum(counts),
+        'row_prefix': _prefix_sum(rows),
+        'first_row': first_row,
+        'next_row': cube['next_row'] + len(added_idx),
+    }
+
+
+def update_range_histograms(histograms, removed, added, year_col='Model Year', origin_col='EV Regional Origin',
+                            value_col='Electric Range'):
+    ## The same kind of patch as `update_count_cube`, for the range histograms. New origins are added after the old ones
+    removed = removed[removed[year_col].notna() & removed[value_col].notna()]
+    added = added[added[year_col].notna() & added[value_col].notna()]
+    bin_width = histograms['bin_width']
+
+    ## Bins are labelled by their lower edge here, so old and new bins line up exactly
+    edges = (histograms['values'] - (bin_width - 1) / 2).astype(np.int64)
+    added_values = added[value_col].to_numpy(dtype=np.int64)
+    all_edges = np.concatenate([edges, added_values])
+    if len(all_edges):
+        value_min = edges[0] if len(edges) else added_values.min()
+        value_min -= -(-max(value_min - all_edges.min(), 0) // bin_width) * bin_width
+        n_bins = (all_edges.max() - value_min) // bin_width + 1
+        new_edges = value_min + np.arange(n_bins) * bin_width
+    else:
+        new_edges = edges
+
+    ## Still alphabetical, so a new origin gets its violin in the same place a rebuild would put it
+    origins = sorted(set(histograms['origins']) | set(added[origin_col].dropna()))
+
+    old_axes = [histograms['years'], histograms['origins'], edges]
+    new_axes = [_merged_years(histograms['years'], added[year_col].to_numpy().astype(np.int64)), origins, new_edges]
+    counts = _reindex(np.diff(histograms['count_prefix'], axis=0), old_axes, new_axes)
+    shape = counts.shape
+
+    for frame, sign in ((removed, -1), (added, 1)):
+        if len(frame) == 0:
+            continue
+        flat_idx = np.ravel_multi_index((
+            frame[year_col].to_numpy().astype(np.int64) - new_axes[0][0],
+            pd.Categorical(frame[origin_col], categories=origins).codes.astype(np.int64),
+            (frame[value_col].to_numpy(dtype=np.int64) - new_edges[0]) // bin_width,
+        ), shape)
+        np.add.at(counts.reshape(-1), flat_idx, sign)
+
+    return {
+        'years': new_axes[0],
+        'origins': origins,
+        'values': new_edges + (bin_width - 1) / 2,
+        'bin_width': bin_width,
+        'count_prefix': _prefix_sum(counts),
+    }
+
+
+# ## Merging the aggregates of separate parts
+#
+# The counts in the cube and the histograms simply add up, so two parts of the data can be counted on their own (even
+# in different processes) and their aggregates merged afterwards, the same way a delta is patched in above. This is
+# what lets `ev_ingest.py` count a csv that does not fit in memory one block of rows at a time.
+
+def merge_count_cubes(cube, other):
+    ## The cube of `cube`'s rows followed by `other`'s rows, as if they had been counted together in that order
+    new_axes = [
+        _merged_years(cube['years'], other['years']),
+        sorted(set(cube['origins']) | set(other['origins'])),
+        sorted(set(cube['counties'][:-1]) | set(other['counties'][:-1])) + [OTHER_COUNTY],
+    ]
+    counts, rows, first_row = 0, 0, np.iinfo(np.int64).max
+    for part, offset in ((cube, 0), (other, cube['next_row'])):
+        old_axes = [part['years'], part['origins'], part['counties']]
+        counts = counts + _reindex(np.diff(part['count_prefix'], axis=0), old_axes, new_axes)
+        rows = rows + _reindex(np.diff(part['row_prefix'], axis=0), old_axes, new_axes)
+        ## The positions in `other` come after every row of `cube`, empty slots stay at the largest int64
+        part_first = _reindex(part['first_row'], old_axes, new_axes, fill=np.iinfo(np.int64).max)
+        first_row = np.minimum(first_row, np.where(part_first == np.iinfo(np.int64).max, part_first, part_first + offset))
+
+    return {
+        'years': new_axes[0],
+        'origins': new_axes[1],
+        'counties': new_axes[2],
+        'count_prefix': _prefix_sum(counts),
+        'row_prefix': _prefix_sum(rows),
+        'first_row': first_row,
+        'next_row': cube['next_row'] + other['next_row'],
+    }
+
+
+def merge_range_histograms(histograms, other):
+    ## The histograms of both parts added together, with the origins of both in alphabetical order. Both need the same
+    ## bin width, with lined up bins
+    bin_width = histograms['bin_width']
+    edges = [(part['values'] - (bin_width - 1) / 2).astype(np.int64) for part in (histograms, other)]
+    if other['bin_width'] != bin_width or (len(edges[0]) and len(edges[1]) and (edges[1][0] - edges[0][0]) % bin_width):
+        raise ValueError('Only histograms with the same, lined up bins can be merged')
+
+    all_edges = np.concatenate(edges)
+    new_edges = np.arange(all_edges.min(), all_edges.max() + 1, bin_width) if len(all_edges) else all_edges
+    origins = sorted(set(histograms['origins']) | set(other['origins']))
+    new_axes = [_merged_years(histograms['years'], other['years']), origins, new_edges]
+
+    counts = sum(_reindex(np.diff(part['count_prefix'], axis=0), [part['years'], part['origins'], part_edges], new_axes)
+                 for part, part_edges in zip((histograms, other), edges))
+    return {
+        'years': new_axes[0],
+        'origins': new_axes[1],
+        'values': new_edges + (bin_width - 1) / 2,
+        'bin_width': bin_width,
+        'count_prefix': _prefix_sum(counts),
+    }
+
+
+# ## Location bins for the map
+#
+# Every vehicle comes with its `Vehicle Location` as a WKT `POINT (lon lat)` string. There are far fewer distinct
+# locations than vehicles, and the column is a category, so each distinct string is parsed once: all of them are joined
+# into one block of text and read by pandas' C csv parser in a single call, and every row then picks up its coordinates
+# through its category code. No Python runs per row (or even per location).
+#
+# For the map, the points are projected to Web Mercator (the projection of the map tiles) and counted into square
+# cells of `MAP_CELL_METERS`, per (Model Year, origin), with a cumulative sum along the years again. Only cells that
+# have a vehicle in them are kept. The cells are numbered from the projection's origin, so the cells of two parts of the
+# data line up, and their counts can be merged like the cube's. Any `year_range` and origin then comes down to
+# subtracting two slices over the occupied cells and scattering the result into an image.
+
+def parse_points(locations):
+    ## (lon, lat) float arrays from WKT `POINT (lon lat)` strings, NaN where the location is missing or unreadable
+    locations = pd.Series(locations)
+    if not isinstance(locations.dtype, pd.CategoricalDtype):
+        locations = locations.astype('category')
+    ## Only the locations some row has are parsed (a handful of new rows still carry every location as a category)
+    codes = locations.cat.codes.to_numpy()
+    used = np.unique(codes[codes >= 0])
+    categories = locations.cat.categories[used].astype(str)
+
+    text = '\n'.join(categories).replace('POINT (', '').replace(')', '')
+    try:
+        points = pd.read_csv(io.StringIO(text), sep=' ', header=None, names=['lon', 'lat'], dtype=float,
+                             skip_blank_lines=False).to_numpy()
+        if len(points) != len(categories):
+            raise ValueError('Some locations did not come out as one point each')
+    except ValueError:
+        ## Anything but plain points (e.g. `POINT EMPTY`) trips up the fast way, so those go through a regular expression
+        points = pd.Series(categories).str.extract(r'^POINT \((\S+) (\S+)\)$').apply(pd.to_numeric, errors='coerce').to_numpy()
+
+    ## Code -1 (a missing location) picks up the trailing NaN
+    points = np.vstack([points, [np.nan, np.nan]])
+    position = np.full(len(locations.cat.categories) + 1, -1)
+    position[used] = np.arange(len(used))
+    rows = position[codes]
+    return points[rows, 0], points[rows, 1]
+
+
+def _unique_cells(cells):
+    ## Like np.unique(cells, axis=0, return_inverse=True), much quicker on one int64 key per cell. A cell's numbers are
+    ## well within 32 bits anywhere on the map, so the keys sort the same way as the (x, y) pairs
+    keys = (cells[:, 0] << 32) + cells[:, 1]
+    _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    return cells[first].reshape(-1, 2), inverse.reshape(-1)
+
+
+def web_mercator(lon, lat):
+    ## Longitude and latitude in degrees to Web Mercator x and y in metres
+    x = np.radians(lon) * EARTH_RADIUS
+    y = np.log(np.tan(np.pi / 4 + np.radians(lat) / 2)) * EARTH_RADIUS
+    return x, y
+
+
+def build_location_bins(frame, cell_size=MAP_CELL_METERS, year_col='Model Year', origin_col='EV Regional Origin',
+                        location_col='Vehicle Location', state_col='State', state='WA'):
+    ## Vehicle counts per (year, origin, occupied map cell) for the vehicles registered in `state`
+    x, y = web_mercator(*parse_points(frame[location_col]))
+    keep = frame[year_col].notna().to_numpy() & (frame[state_col] == state).to_numpy() & np.isfinite(x) & np.isfinite(y)
+    frame = frame[keep]
+
+    years = frame[year_col].to_numpy().astype(np.int64)
+    year_labels = np.arange(years.min(), years.max() + 1) if len(years) else np.arange(0)
+    origin_labels = sorted(frame[origin_col].dropna().unique())
+    origin_idx = pd.Categorical(frame[origin_col], categories=origin_labels).codes.astype(np.int64)
+
+    cells, cell_idx = _unique_cells(np.floor(np.column_stack([x[keep], y[keep]]) / cell_size).astype(np.int64))
+
+    ## Rows without an origin are left out, the same way the count cube leaves them out
+    has_origin = origin_idx >= 0
+    shape = (len(year_labels), len(origin_labels), len(cells))
+    flat_idx = np.ravel_multi_index((years[has_origin] - (year_labels[0] if len(year_labels) else 0), origin_idx[has_origin],
+                                     cell_idx[has_origin]), shape)
+    counts = np.bincount(flat_idx, minlength=int(np.prod(shape))).reshape(shape)
+
+    return {
+        'years': year_labels,
+        'origins': origin_labels,
+        'cell_size': cell_size,
+        'cells': cells,
+        'count_prefix': _prefix_sum(counts),
+    }
+
+
+def location_bin_counts(bins, year_range, ev_origin):
+    ## Number of vehicles in every occupied cell, for an inclusive `year_range` and one origin (or 'All')
+    lo, hi = _year_slice(bins, year_range)
+    origins = _origin_positions(bins, ev_origin)
+    return (bins['count_prefix'][hi][origins] - bins['count_prefix'][lo][origins]).sum(axis=0)
+
+
+def location_grid(bins, counts):
+    ## The counts of `location_bin_counts` as an image over every occupied cell (the first row is the top), NaN where no
+    ## vehicle is, and its (left, bottom, right, top) bounds in Web Mercator metres
+    cells, cell_size = bins['cells'], bins['cell_size']
+    if len(cells) == 0:
+        return np.full((1, 1), np.nan, dtype=np.float32), (0, 0, cell_size, cell_size)
+    low, high = cells.min(axis=0), cells.max(axis=0)
+    width, height = high - low + 1
+
+    image = np.full((height, width), np.nan, dtype=np.float32)
+    present = counts > 0
+    image[cells[present, 1] - low[1], cells[present, 0] - low[0]] = counts[present]
+    return image[::-1], (low[0] * cell_size, low[1] * cell_size, (high[0] + 1) * cell_size, (high[1] + 1) * cell_size)
+
+
+def merge_location_bins(bins, other, sign=1):
+    ## The location bins of both parts added together, or with `other` taken out of `bins` for sign=-1
+    if bins['cell_size'] != other['cell_size']:
+        raise ValueError('Only location bins with the same cell size can be merged')
+    new_years = _merged_years(bins['years'], other['years'])
+    new_origins = sorted(set(bins['origins']) | set(other['origins']))
+    cells, cell_idx = _unique_cells(np.concatenate([bins['cells'], other['cells']]))
+
+    counts = np.zeros((len(new_years), len(new_origins), len(cells)), dtype=np.int64)
+    for part, part_sign, positions in ((bins, 1, cell_idx[:len(bins['cells'])]), (other, sign, cell_idx[len(bins['cells']):])):
+        year_pos = pd.Index(new_years).get_indexer(part['years'])
+        origin_pos = pd.Index(new_origins).get_indexer(part['origins'])
+        counts[np.ix_(year_pos, origin_pos, positions)] += part_sign * np.diff(part['count_prefix'], axis=0)
+
+    ## Cells whose last vehicle was taken out are dropped, like a cell with no vehicle in it is never kept in the first place
+    occupied = counts.any(axis=(0, 1))
+    cells, counts = cells[occupied], counts[:, :, occupied]
+
+    return {
+        'years': new_years,
+        'origins': new_origins,
+        'cell_size': bins['cell_size'],
+        'cells': cells,
+        'count_prefix': _prefix_sum(counts),
+    }
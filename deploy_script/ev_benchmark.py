@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Benchmarking the four plot functions
+#
+# To see how `create_barplot`, `create_dot_plot`, `create_heatmap` and `create_violin_plot` hold up as the dataset
+# grows, this builds synthetic datasets at several multiples of the real one and times every function over a sweep of
+# widget values: every origin for the dropdown plots, and a spread of year ranges (everything, the last few years, the
+# first decade, a few years in the middle and a single year) for the slider plots.
+#
+# The synthetic rows are drawn from the real csv, so they have the same columns, types and distinct values (every real
+# row is used at least once) and the same mix of makes, years and counties. Only `DOL Vehicle ID` is renumbered so it
+# stays unique. Every scale runs in a fresh process, which loads the synthetic data into `dashboard_data()` and then runs
+# the dashboard script as a session would.
+#
+# For every call we record, with the plot cache cleared first:
+# <li>`build_seconds`: running the `create_*` function (the median over `repeats` calls). When it returns a DynamicMap
+# (the zoomable dot plot), working out its first image counts here too, rather than under rendering</li>
+# <li>`render_seconds`: turning the result into Bokeh models, which is what gets sent to the browser</li>
+# <li>`payload_bytes`: the size of those Bokeh models as JSON</li>
+# <li>`peak_traced_mb`: the largest amount of memory allocated at once during the build and render</li>
+#
+# Everything goes into one JSON file. Run `python ev_benchmark.py --compare old.json` to see how a new run compares to
+# an older one. It has to be run next to `./csv/`, the same way the dashboard is served.
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import statistics
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+
+SCALES = (1, 10, 100)
+RESULTS_PATH = './benchmark_results.json'
+BENCHMARK_SEED = 521
+REPEATS = 3
+
+PLOT_FUNCTIONS = {
+    'create_barplot': 'ev_origin',
+    'create_dot_plot': 'ev_origin',
+    'create_heatmap': 'year_range',
+    'create_violin_plot': 'year_range',
+}
+
+
+def synthetic_dataset(source, scale, seed=BENCHMARK_SEED):
+    ## `scale` times as many rows as `source`, drawn from its rows. From 1x up every row of `source` is in there at
+    ## least once, so every column keeps all of its distinct values
+    rng = np.random.default_rng(seed)
+    rows = max(int(round(len(source) * scale)), 1)
+    if rows >= len(source):
+        picks = np.concatenate([np.arange(len(source)), rng.integers(0, len(source), rows - len(source))])
+        picks = rng.permutation(picks)
+    else:
+        picks = rng.choice(len(source), rows, replace=False)
+
+    frame = source.take(picks).reset_index(drop=True)
+    if 'DOL Vehicle ID' in frame.columns:
+        frame['DOL Vehicle ID'] = np.arange(1, rows + 1, dtype=np.int64)
+    frame.attrs['source_sha256'] = 'synthetic-{}x-{}'.format(scale, seed)
+    return frame
+
+
+def year_range_sweep(years):
+    first, last = int(years[0]), int(years[-1])
+    middle = (first + last) // 2
+    sweep = [(first, last), (last - 4, last), (first, first + 9), (middle - 2, middle + 2), (last, last)]
+    sweep = [(max(lo, first), min(hi, last)) for lo, hi in sweep]
+    return list(dict.fromkeys(sweep))
+
+
+def payload_bytes(model):
+    from bokeh.embed import json_item
+    ## json_item warns about the Python callbacks of the dot plot's zoom stream, which only matter for standalone pages
+    logging.getLogger('bokeh.embed.util').setLevel(logging.ERROR)
+    return len(json.dumps(json_item(model)))
+
+
+def benchmark_call(func, kwargs, repeats=REPEATS):
+    import holoviews as hv
+    import ev_cache
+
+    build, render = [], []
+    for _ in range(repeats):
+        ## Every call starts from an empty cache, otherwise everything after the first one would just be a cache hit
+        ev_cache.clear()
+        start = time.perf_counter()
+        plot = func(**kwargs)
+        if isinstance(plot, hv.DynamicMap):
+            ## A DynamicMap is only a recipe until it is first evaluated, which would otherwise be timed as rendering
+            plot[()]
+        build.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        model = hv.render(plot, backend='bokeh')
+        render.append(time.perf_counter() - start)
+
+    ## Memory is measured on a separate call, since tracing every allocation slows the call down
+    ev_cache.clear()
+    tracemalloc.start()
+    hv.render(func(**kwargs), backend='bokeh')
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        'build_seconds': statistics.median(build),
+        'render_seconds': statistics.median(render),
+        'payload_bytes': payload_bytes(model),
+        'peak_traced_mb': peak / 2 ** 20,
+    }
+
+
+def run_scale(scale, seed=BENCHMARK_SEED, repeats=REPEATS):
+    ## Runs inside a fresh process, so the peak RSS is only that of this one scale
+    import resource
+    import runpy
+    import warnings
+    from ev_data import DASHBOARD_COLUMNS, load_dataset, prepare_dashboard_data, set_dashboard_data
+
+    warnings.filterwarnings('ignore')
+    frame = synthetic_dataset(load_dataset(DASHBOARD_COLUMNS), scale, seed)
+
+    start = time.perf_counter()
+    data = prepare_dashboard_data(frame)
+    prepare_seconds = time.perf_counter() - start
+    set_dashboard_data(data)
+
+    start = time.perf_counter()
+    session = runpy.run_path(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'introduction.py'))
+    session_seconds = time.perf_counter() - start
+
+    sweeps = {
+        'ev_origin': data['origins'] + ['All'],
+        'year_range': year_range_sweep(data['ev_count_cube']['years']),
+    }
+    results = []
+    for name, widget in PLOT_FUNCTIONS.items():
+        for value in sweeps[widget]:
+            result = benchmark_call(session[name], {widget: value}, repeats)
+            ## Year ranges are kept as lists, the way they come back out of the JSON file
+            results.append(dict({'function': name, 'widget': widget, 'value': list(value) if widget == 'year_range' else value},
+                                **result))
+            print('{:>5}x {:<20} {:<28} build {:7.3f}s  render {:7.3f}s  {:10,d} bytes'.format(
+                scale, name, str(value), result['build_seconds'], result['render_seconds'], result['payload_bytes']))
+
+    return {
+        'scale': scale,
+        'rows': len(frame),
+        'prepare_seconds': prepare_seconds,
+        'session_seconds': session_seconds,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'results': results,
+    }
+
+
+def _versions():
+    import bokeh
+    import holoviews
+    import panel
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+            'holoviews': holoviews.__version__, 'bokeh': bokeh.__version__, 'panel': panel.__version__}
+
+
+def results_table(report):
+    ## One row per (scale, function, widget value), handy for comparing runs
+    rows = [dict(result, scale=run['scale'], rows=run['rows'], value=str(result['value']))
+            for run in report['runs'] for result in run['results']]
+    return pd.DataFrame(rows).set_index(['scale', 'function', 'value'])
+
+
+def compare_results(old_report, new_report, column='build_seconds'):
+    ## `column` from both runs side by side, with new / old as the ratio (above 1 means the new run is slower)
+    old, new = results_table(old_report)[column], results_table(new_report)[column]
+    table = pd.DataFrame({'old': old, 'new': new}).dropna()
+    table['ratio'] = table['new'] / table['old']
+    return table
+
+
+if __name__ == '__main__':
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    parser = argparse.ArgumentParser(description='Time the dashboard plot functions on synthetic data.')
+    parser.add_argument('--scales', type=float, nargs='+', default=SCALES, help='multiples of the real row count')
+    parser.add_argument('--repeats', type=int, default=REPEATS)
+    parser.add_argument('--seed', type=int, default=BENCHMARK_SEED)
+    parser.add_argument('--output', default=RESULTS_PATH)
+    parser.add_argument('--compare', help='an earlier results file to compare this run against')
+    args = parser.parse_args()
+
+    report = {
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'versions': _versions(),
+        'seed': args.seed,
+        'repeats': args.repeats,
+        'runs': [],
+    }
+    for scale in args.scales:
+        scale = int(scale) if float(scale).is_integer() else scale
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+            run = pool.submit(run_scale, scale, args.seed, args.repeats).result()
+        print('{:>5}x {:,} rows: prepare {:.2f}s, session {:.2f}s, peak RSS {:.0f} MB'.format(
+            scale, run['rows'], run['prepare_seconds'], run['session_seconds'], run['peak_rss_mb']))
+        report['runs'].append(run)
+
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=2)
+    print('Saved to', args.output)
+
+    if args.compare:
+        with open(args.compare) as previous:
+            print(compare_results(json.load(previous), report).to_string())
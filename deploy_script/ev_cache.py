@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Shared results cache for the plot functions
+#
+# `panel serve` runs the dashboard script once for every browser session, so every visitor used to rebuild the same
+# plots for the same widget values, even if someone else had asked for exactly that plot a moment earlier. This module
+# is imported once per server process, so anything stored in it is shared by every session in that process.
+#
+# Functions wrapped with `@cached` remember their result under the function name plus the widget values passed in
+# (`ev_origin`, `year_range`, ...). The cache holds at most `MAX_RESULTS` plots; once full, the plot that was used least
+# recently is dropped first. Every result is tied to the dataset it was computed from: when `set_data_version` is
+# called with a different version (e.g. the csv changed), everything is thrown away, and plots that were still being
+# built at that moment are not stored.
+
+import functools
+import inspect
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+
+MAX_RESULTS = 128
+
+_results = OrderedDict()
+_stats = {}
+_lock = threading.Lock()
+_data_version = None
+
+
+def _counters(name):
+    return _stats.setdefault(name, {'hits': 0, 'misses': 0, 'evictions': 0})
+
+
+def set_data_version(version):
+    ## Called with something that identifies the loaded dataset (its source hash). Results from any other version are dropped
+    global _data_version
+    with _lock:
+        if version != _data_version:
+            _results.clear()
+            _data_version = version
+
+
+def clear():
+    with _lock:
+        _results.clear()
+
+
+def cached(func):
+    ## The key uses the function's name rather than the function itself, since every session defines its own copy of it
+    name = func.__qualname__
+    signature = inspect.signature(func)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        ## Binding to the signature makes f('All') and f(ev_origin='All') share one entry
+        arguments = signature.bind(*args, **kwargs)
+        arguments.apply_defaults()
+        key = (name, tuple(arguments.arguments.items()))
+        with _lock:
+            if key in _results:
+                _results.move_to_end(key)
+                _counters(name)['hits'] += 1
+                return _results[key]
+            _counters(name)['misses'] += 1
+            version = _data_version
+
+        ## The plot is built outside of the lock, so a slow plot does not hold up every other session
+        result = func(*args, **kwargs)
+
+        with _lock:
+            ## The data was refreshed while this plot was being built, so it may mix old and new data. It is still
+            ## returned to the session that asked for it, which redraws anyway once it sees the new version
+            if version != _data_version:
+                return result
+            _results[key] = result
+            _results.move_to_end(key)
+            while len(_results) > MAX_RESULTS:
+                (evicted_name, _), _ = _results.popitem(last=False)
+                _counters(evicted_name)['evictions'] += 1
+        return result
+
+    return wrapper
+
+
+def cache_stats():
+    ## Hits, misses, evictions and currently stored results for every cached function
+    with _lock:
+        stored = pd.Series([key[0] for key in _results], dtype=object).value_counts()
+        stats = pd.DataFrame.from_dict(_stats, orient='index', columns=['hits', 'misses', 'evictions'])
+    stats['stored'] = stored.reindex(stats.index, fill_value=0)
+    return stats
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Running the plot callbacks off the event loop
+#
+# Every Panel session handles its widget events on the server's event loop. Before, moving the year slider ran
+# `create_heatmap` and then `create_violin_plot` right there, one after the other, for every value the slider passed
+# through while being dragged. While that happened, the session could not react to anything else.
+#
+# `in_background` turns a plot function into an async one that runs in a shared pool of worker threads. Panel awaits
+# async callbacks without blocking the event loop, so the two plots bound to the same widget are built at the same
+# time and the page stays responsive. When a newer widget value arrives before a plot is done, Panel cancels the old
+# call: if it had not started yet it never runs, and if it is already running its result is thrown away instead of
+# replacing the newer plot. Together with binding to the slider's `value_throttled` (which only changes once the
+# handle is released), the heavy plots are only built for the values a user actually settles on.
+#
+# Only the `data_prep` half of the plots really runs side by side. HoloViews keeps the options of every plot in one
+# store for the whole process, and handing out the ids of new options there is not thread safe, so plots built at the
+# same time would end up with each other's options (or none). Every `plot_build` block, and anything else that makes
+# or restyles a HoloViews object, runs inside `plot_build()`, which lets one thread at a time in.
+#
+# Running this file directly (`python ev_callbacks.py`) measures a simulated slider drag both ways.
+
+import asyncio
+import contextlib
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from ev_metrics import callback_returned, phase
+
+
+PLOT_THREADS = 4
+
+PLOT_EXECUTOR = ThreadPoolExecutor(max_workers=PLOT_THREADS, thread_name_prefix='ev-plots')
+
+## Re-entrant, since some plots are put together from smaller ones that are built the same way
+PLOT_BUILD_LOCK = threading.RLock()
+
+
+@contextlib.contextmanager
+def plot_build():
+    ## The `plot_build` phase, holding the process wide lock around HoloViews. The time spent waiting for the lock is
+    ## not counted as part of the phase
+    with PLOT_BUILD_LOCK, phase('plot_build'):
+        yield
+
+
+def in_background(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        ## Cancelling this coroutine (Panel does that when a newer value comes in) also cancels the queued thread pool call
+        result = await asyncio.wrap_future(PLOT_EXECUTOR.submit(func, *args, **kwargs))
+        ## Back on the event loop, where Panel applies the result, so the metrics can tell which callback it came from
+        callback_returned(func.__name__)
+        return result
+
+    return wrapper
+
+
+def time_slider_drag(plot_functions, drag_values, throttled_concurrent):
+    ## Time until every plot shows the final value of a drag. The old way builds every plot for every value the slider
+    ## passes through, one plot after the other. The new way only builds the released value, with all plots at once
+    start = time.perf_counter()
+    if throttled_concurrent:
+        futures = [PLOT_EXECUTOR.submit(plot_function, drag_values[-1]) for plot_function in plot_functions]
+        for future in futures:
+            future.result()
+    else:
+        for value in drag_values:
+            for plot_function in plot_functions:
+                plot_function(value)
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    import os
+    import runpy
+    import ev_cache
+
+    dashboard = runpy.run_path(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'introduction.py'))
+    years = dashboard['ev_count_cube']['years']
+    plot_functions = [dashboard['create_heatmap'], dashboard['create_violin_plot']]
+
+    ## Dragging the left handle of the slider across the first 15 model years
+    drag_values = [(int(years[0]) + step, int(years[-1])) for step in range(15)]
+
+    for name, throttled_concurrent in [('every value, one after another', False), ('released value, concurrent', True)]:
+        ## Start from an empty plot cache each time, otherwise the second run would just be cache hits
+        ev_cache.clear()
+        print('{:<32} {:6.3f}s'.format(name + ':', time_slider_drag(plot_functions, drag_values, throttled_concurrent)))
@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Filtering in the browser
+#
+# Normally every change of the dropdown or the slider goes to the server, which builds the two plots for the new value
+# and sends their data back down. In this mode the data the plots are made from is sent to the browser once, when the
+# page loads, and everything after that happens in JavaScript, with no Python callback and no plot data going back and
+# forth.
+#
+# Two data sources are shared by the plots:
+# <li>`counts`: the number of vehicles for every (Model Year, EV Regional Origin, County) that has any, which is the count
+# cube from `ev_aggregates.py` written out as rows. The bar plot adds it up per year for the chosen origin, and the
+# heatmap per county and origin for the chosen years.</li>
+# <li>`vehicles`: `Jitter`, `Electric Range`, origin, EV type and model year for every vehicle the dot and violin plots
+# show. The dot plot picks out the vehicles of the chosen origin with a `BooleanFilter`, and the violin plot counts the
+# ranges of the chosen years into 1 mile bins and works out the same KDE, quartiles and whiskers as
+# `histogram_violins`.</li>
+#
+# The plots are first drawn for the current widget values in Python, with the same aggregate functions the server uses,
+# and the JavaScript below redoes the same work whenever a widget changes. The dot plot always draws every vehicle
+# (with WebGL), since there is no server to rebuild a density image when zooming. Redoing the heatmap and violin plot
+# only takes a few milliseconds here, so they follow the slider while it is dragged instead of waiting for it to be let
+# go. The widget values are still synced to the server by Panel (a few bytes per change), but nothing is computed there. When the data is refreshed, `update`
+# puts the new data into the same sources. The map is not part of this mode: its counts per location are far too many
+# to send to the browser, so `introduction.py` leaves it out of the page when filtering here.
+
+import numpy as np
+import pandas as pd
+from bokeh.core.property.validation import validate
+from bokeh.models import (BooleanFilter, CDSView, ColorBar, ColumnDataSource, CustomJSTickFormatter, FactorRange,
+                          FixedTicker, HoverTool, Label, LogColorMapper)
+from bokeh.plotting import figure
+
+from ev_aggregates import cube_county_origin_counts, cube_year_counts, cube_year_totals, histogram_violins
+
+
+## The colours hvplot gave the violins, kept with their origin whatever position it ends up in
+VIOLIN_COLORS = {'Asia': 'red', 'Europe': 'silver', 'North America': 'blue'}
+VIOLIN_OTHER_COLOR = 'grey'
+VIOLIN_WIDTH = 0.8
+VIOLIN_SAMPLES = 100
+VIOLIN_CUT = 5
+
+## The colours HoloViews gives the first two groups of a plot, so the dots look the same as in the server version
+DOT_COLORS = ['#30a2da', '#fc4f30']
+
+
+def count_columns(cube):
+    counts = np.diff(cube['count_prefix'], axis=0)
+    year, origin, county = np.nonzero(counts)
+    return {
+        'Model Year': cube['years'][year].astype(np.int32),
+        'EV Regional Origin': np.array(cube['origins'], dtype=object)[origin],
+        'County': np.array(cube['counties'], dtype=object)[county],
+        'Number of EVs': counts[year, origin, county].astype(np.int32),
+    }
+
+
+def vehicle_columns(violin__dot_df, origins):
+    ## Small dtypes, since these go to the browser one value per vehicle. Ranges and years are whole numbers
+    return {
+        'Jitter': violin__dot_df['Jitter'].to_numpy(dtype=np.float32),
+        'Electric Range': violin__dot_df['Electric Range'].to_numpy(dtype=np.int32),
+        'Model Year': violin__dot_df['Model Year'].to_numpy(dtype=np.int32),
+        'origin': pd.Categorical(violin__dot_df['EV Regional Origin'], categories=origins).codes.astype(np.int8),
+        'type': violin__dot_df['Electric Vehicle Type Code'].to_numpy(dtype=np.int8),
+    }
+
+
+def bar_columns(cube, ev_origin):
+    counts = cube_year_counts(cube, ev_origin)
+    counts = counts[counts['Number of EVs'] > 0]
+    return {'Model Year': counts['Model Year'].to_numpy(), 'Number of EVs': counts['Number of EVs'].to_numpy()}
+
+
+def heatmap_columns(cube, year_range, counties, origins):
+    ## One cell for every county and origin, the empty ones as NaN so they are left blank like in the server version
+    grid = cube_county_origin_counts(cube, year_range, counties).reindex(index=counties, columns=origins).fillna(0)
+    return {
+        'County': np.repeat(counties, len(origins)),
+        'EV Regional Origin': np.tile(origins, len(counties)),
+        'Number of EVs Registered': np.where(grid.to_numpy() > 0, grid.to_numpy(), np.nan).ravel().astype(float),
+    }
+
+
+def dot_booleans(columns, ev_origin, origins, ev_type):
+    ## Which vehicles one EV type's dots show. Kept as a numpy array, so Bokeh sends it as one binary buffer
+    selected = columns['type'] == ev_type
+    if ev_origin != 'All':
+        selected &= columns['origin'] == (origins.index(ev_origin) if ev_origin in origins else -2)
+    return selected
+
+
+def violin_columns(histograms, year_range):
+    outlines = {'xs': [], 'ys': [], 'EV Regional Origin': [], 'color': []}
+    whiskers = {'x0': [], 'y0': [], 'x1': [], 'y1': []}
+    boxes = {'left': [], 'right': [], 'bottom': [], 'top': []}
+    medians = {'x': [], 'y': []}
+
+    violins = histogram_violins(histograms, year_range, VIOLIN_SAMPLES, VIOLIN_CUT)
+    for i, origin in enumerate(histograms['origins']):
+        if origin not in violins:
+            continue
+        violin = violins[origin]
+        ## Only the box and median for an origin whose vehicles all have the same range
+        if violin['density'] is not None:
+            half_width = violin['density'] / violin['density'].max() * VIOLIN_WIDTH / 2
+            outlines['xs'].append(np.concatenate([i - half_width, (i + half_width)[::-1]]))
+            outlines['ys'].append(np.concatenate([violin['support'], violin['support'][::-1]]))
+            outlines['EV Regional Origin'].append(origin)
+            outlines['color'].append(VIOLIN_COLORS.get(origin, VIOLIN_OTHER_COLOR))
+        for column, value in zip(whiskers, (i, violin['lower'], i, violin['upper'])):
+            whiskers[column].append(value)
+        for column, value in zip(boxes, (i - 0.05, i + 0.05, violin['q1'], violin['q3'])):
+            boxes[column].append(value)
+        medians['x'].append(i)
+        medians['y'].append(violin['q2'])
+    return outlines, whiskers, boxes, medians
+
+
+## What runs in the browser. `cb_obj` is the widget that changed
+
+BAR_JS = """
+const all = cb_obj.value == 'All';
+const years = counts.data['Model Year'], origins = counts.data['EV Regional Origin'], numbers = counts.data['Number of EVs'];
+const totals = new Map();
+for (let i = 0; i < numbers.length; i++) {
+  if (all || origins[i] == cb_obj.value) totals.set(years[i], (totals.get(years[i]) ?? 0) + numbers[i]);
+}
+const shown = [...totals.keys()].filter((year) => totals.get(year) > 0).sort((a, b) => a - b);
+bars.data = {'Model Year': shown, 'Number of EVs': shown.map((year) => totals.get(year))};
+"""
+
+DOT_JS = """
+const all = cb_obj.value == 'All';
+const code = origin_names.data['EV Regional Origin'].indexOf(cb_obj.value);
+const origin = vehicles.data['origin'], type = vehicles.data['type'];
+filters.forEach((filter, ev_type) => {
+  const booleans = new Array(origin.length);
+  for (let i = 0; i < origin.length; i++) booleans[i] = type[i] == ev_type && (all || (code >= 0 && origin[i] == code));
+  filter.booleans = booleans;
+});
+"""
+
+HEATMAP_JS = """
+const lo = Math.ceil(cb_obj.value[0]), hi = Math.floor(cb_obj.value[1]);
+const cell = new Map();
+cells.data['County'].forEach((county, i) => cell.set(county + '\\n' + cells.data['EV Regional Origin'][i], i));
+const sums = new Array(cell.size).fill(0);
+const years = counts.data['Model Year'], origins = counts.data['EV Regional Origin'], counties = counts.data['County'];
+const numbers = counts.data['Number of EVs'];
+for (let i = 0; i < numbers.length; i++) {
+  if (years[i] < lo || years[i] > hi) continue;
+  const at = cell.get(counties[i] + '\\n' + origins[i]);
+  if (at !== undefined) sums[at] += numbers[i];
+}
+const present = sums.filter((sum) => sum > 0);
+if (present.length) {
+  mapper.low = Math.min(...present);
+  mapper.high = Math.max(...present);
+}
+cells.data = Object.assign({}, cells.data, {'Number of EVs Registered': sums.map((sum) => sum > 0 ? sum : NaN)});
+"""
+
+VIOLIN_JS = """
+const lo = Math.ceil(cb_obj.value[0]), hi = Math.floor(cb_obj.value[1]);
+const names = origin_names.data['EV Regional Origin'];
+const year = vehicles.data['Model Year'], origin = vehicles.data['origin'], range = vehicles.data['Electric Range'];
+
+// Every range is a whole number of miles, so 1 mile bins hold one exact value each, the same as build_range_histograms
+const bins = names.map(() => new Map());
+for (let i = 0; i < range.length; i++) {
+  if (year[i] < lo || year[i] > hi || origin[i] < 0) continue;
+  bins[origin[i]].set(range[i], (bins[origin[i]].get(range[i]) ?? 0) + 1);
+}
+
+const outlines = {xs: [], ys: [], 'EV Regional Origin': [], color: []};
+const whisker_data = {x0: [], y0: [], x1: [], y1: []};
+const box_data = {left: [], right: [], bottom: [], top: []};
+const median_data = {x: [], y: []};
+bins.forEach((counts_of, i) => {
+  const values = [...counts_of.keys()].sort((a, b) => a - b);
+  const counts = values.map((value) => counts_of.get(value));
+  const total = counts.reduce((a, b) => a + b, 0);
+  if (total < 2) return;
+
+  // histogram_kde: a Gaussian KDE with Scott's bandwidth, one kernel per bin weighted by its count
+  const mean = values.reduce((sum, value, k) => sum + value * counts[k], 0) / total;
+  const std = Math.sqrt(values.reduce((sum, value, k) => sum + counts[k] * (value - mean) ** 2, 0) / (total - 1));
+  const bandwidth = total ** (-1 / 5) * std;
+  // Every vehicle on the same range leaves nothing to smooth, so that origin only gets its box and median
+  if (bandwidth > 0) {
+    const first = values[0] - cut * bandwidth, last = values[values.length - 1] + cut * bandwidth;
+    const support = Array.from({length: samples}, (_, j) => first + (last - first) * j / (samples - 1));
+    const density = support.map((point) => values.reduce((sum, value, k) =>
+      sum + counts[k] * Math.exp(-0.5 * ((point - value) / bandwidth) ** 2), 0) / (total * bandwidth * Math.sqrt(2 * Math.PI)));
+    const peak = Math.max(...density);
+    const half_width = density.map((value) => value / peak * violin_width / 2);
+    outlines.xs.push(half_width.map((half) => i - half).concat(half_width.map((half) => i + half).reverse()));
+    outlines.ys.push(support.concat([...support].reverse()));
+    outlines['EV Regional Origin'].push(names[i]);
+    outlines.color.push(colors[names[i]] ?? other_color);
+  }
+
+  // histogram_percentile: np.percentile with linear interpolation, on the values the counts stand for
+  const cumulative = [];
+  counts.reduce((sum, count) => { cumulative.push(sum + count); return sum + count; }, 0);
+  const value_at = (rank) => values[cumulative.findIndex((sum) => sum > rank)];
+  const [q1, q2, q3] = [25, 50, 75].map((q) => {
+    const rank = (total - 1) * q / 100;
+    const below = value_at(Math.floor(rank)), above = value_at(Math.ceil(rank));
+    return below + (above - below) * (rank - Math.floor(rank));
+  });
+  const iqr = q3 - q1;
+  const lower = Math.min(Math.min(...values.filter((value) => value >= q1 - 1.5 * iqr)), q1);
+  const upper = Math.max(Math.max(...values.filter((value) => value <= q3 + 1.5 * iqr)), q3);
+
+  whisker_data.x0.push(i); whisker_data.y0.push(lower); whisker_data.x1.push(i); whisker_data.y1.push(upper);
+  box_data.left.push(i - 0.05); box_data.right.push(i + 0.05); box_data.bottom.push(q1); box_data.top.push(q3);
+  median_data.x.push(i); median_data.y.push(q2);
+});
+violins.data = outlines;
+whiskers.data = whisker_data;
+boxes.data = box_data;
+medians.data = median_data;
+"""
+
+
+class ClientSidePlots:
+    ## The four plots, drawn with Bokeh and wired to `select` and `slider` in JavaScript. `dot_plot_ranges` is the
+    ## function giving the dot plot's x and y ranges, and the heatmap's colour bar gets the same ticks as the server one
+
+    def __init__(self, dashboard, select, slider, dot_plot_ranges, heatmap_ticks, heatmap_tick_code):
+        self.select, self.slider, self.dot_plot_ranges = select, slider, dot_plot_ranges
+        self.counts = ColumnDataSource()
+        self.vehicles = ColumnDataSource()
+        self.origin_names = ColumnDataSource()
+        self.bars = ColumnDataSource()
+        self.dot_filters = [BooleanFilter(), BooleanFilter()]
+        self.cells = ColumnDataSource()
+        self.violin_sources = [ColumnDataSource() for _ in range(4)]
+        ## Imported here, so importing this module does not wait for HoloViews (see `ev_startup.py`)
+        from holoviews.plotting.util import process_cmap
+        self.mapper = LogColorMapper(palette=process_cmap('BuPu', 256), nan_color='rgba(0, 0, 0, 0)')
+
+        self.bar_plot = figure(width=700, height=300, y_axis_type='log', title='Number of Registered EVs in WA Per Model Year',
+                               x_axis_label='Model Year', y_axis_label='Number of Registered EVs (Log Scale)', tools='hover,save,pan,wheel_zoom,box_zoom,reset',
+                               tooltips=[('Model Year', '@{Model Year}'), ('Number of EVs', '@{Number of EVs}')])
+        self.bar_plot.vbar(x='Model Year', top='Number of EVs', bottom=1, width=0.8, source=self.bars, color='#30a2da')
+        self.bar_plot.add_layout(Label(x=2001, y=120, text='*Unit increase in Y = 10× more EVs', text_font_size='10pt',
+                                       background_fill_color='white'))
+
+        ## WebGL, since every vehicle is drawn as its own dot
+        self.dot_plot = figure(width=600, height=600, output_backend='webgl', x_axis_label='Electric Vehicle Type',
+                               y_axis_label='Electric Range (mi)', title='Range Comparison for Battery Electric and Plug-in Hybrid Vehicles')
+        for ev_type, dot_filter in enumerate(self.dot_filters):
+            self.dot_plot.scatter('Jitter', 'Electric Range', source=self.vehicles, view=CDSView(filter=dot_filter),
+                                  color=DOT_COLORS[ev_type], size=4)
+
+        self.heatmap = figure(width=700, height=300, x_range=FactorRange(), y_range=FactorRange(), x_axis_label='EV Car Model Origin',
+                              y_axis_label='Washington State County', title='Top 10 WA Counties: EVs Registered by Car Origin (Log Scale)',
+                              tools='hover,save,reset', tooltips=[('County', '@County'), ('EV Regional Origin', '@{EV Regional Origin}'),
+                                                                  ('Number of EVs Registered', '@{Number of EVs Registered}')])
+        self.heatmap.rect('EV Regional Origin', 'County', 1, 1, source=self.cells, line_color=None,
+                          fill_color={'field': 'Number of EVs Registered', 'transform': self.mapper})
+        self.heatmap.add_layout(ColorBar(color_mapper=self.mapper, title='Raw Number of EVs (w/ Log Scale)',
+                                         ticker=FixedTicker(ticks=heatmap_ticks), formatter=CustomJSTickFormatter(code=heatmap_tick_code)), 'right')
+
+        self.violin_plot = figure(width=600, height=600, y_range=(-25, 400), x_axis_label='EV Regional Origin', y_axis_label='Electric Range (mi)',
+                                  title='Distribution of Electric Range Distances Grouped by EV Origin Region')
+        outlines, whiskers, boxes, medians = self.violin_sources
+        violin_renderer = self.violin_plot.patches('xs', 'ys', source=outlines, fill_color='color', line_color='black')
+        self.violin_plot.add_tools(HoverTool(renderers=[violin_renderer], tooltips=[('EV Regional Origin', '@{EV Regional Origin}')]))
+        self.violin_plot.segment('x0', 'y0', 'x1', 'y1', source=whiskers, color='black')
+        self.violin_plot.quad(left='left', right='right', bottom='bottom', top='top', source=boxes, color='black')
+        self.violin_plot.scatter('x', 'y', source=medians, color='white', size=5)
+
+        self.update(dashboard)
+
+        select.jscallback(value=BAR_JS, args={'counts': self.counts, 'bars': self.bars})
+        select.jscallback(value=DOT_JS, args={'vehicles': self.vehicles, 'origin_names': self.origin_names, 'filters': self.dot_filters})
+        slider.jscallback(value=HEATMAP_JS, args={'counts': self.counts, 'cells': self.cells, 'mapper': self.mapper})
+        slider.jscallback(value=VIOLIN_JS, args=dict(
+            vehicles=self.vehicles, origin_names=self.origin_names, violins=outlines, whiskers=whiskers, boxes=boxes, medians=medians,
+            colors=VIOLIN_COLORS, other_color=VIOLIN_OTHER_COLOR, violin_width=VIOLIN_WIDTH, samples=VIOLIN_SAMPLES, cut=VIOLIN_CUT))
+
+    @property
+    def plots(self):
+        return self.bar_plot, self.dot_plot, self.heatmap, self.violin_plot
+
+    def update(self, dashboard):
+        ## Puts `dashboard`'s data into the shared sources and redraws the plots for the current widget values
+        ## Everything here is built from the dashboard data, so Bokeh does not need to check every value of every column on
+        ## its own, which would take longer than everything else here put together
+        with validate(False):
+            self._update(dashboard)
+
+    def _update(self, dashboard):
+        cube, histograms = dashboard['ev_count_cube'], dashboard['range_histograms']
+        origins = list(histograms['origins'])
+        year_range = self.slider.value
+
+        self.counts.data = count_columns(cube)
+        vehicles = vehicle_columns(dashboard['violin__dot_df'], origins)
+        self.vehicles.data = vehicles
+        self.origin_names.data = {'EV Regional Origin': origins}
+
+        self.bars.data = bar_columns(cube, self.select.value)
+        self.bar_plot.x_range.update(start=cube['years'][0] - 2, end=cube['years'][-1] + 2)
+        self.bar_plot.y_range.update(start=2, end=cube_year_totals(cube).max())
+
+        for ev_type, dot_filter in enumerate(self.dot_filters):
+            dot_filter.booleans = dot_booleans(vehicles, self.select.value, origins, ev_type)
+        (x_start, x_end), (y_start, y_end) = self.dot_plot_ranges()
+        self.dot_plot.x_range.update(start=x_start, end=x_end)
+        self.dot_plot.y_range.update(start=y_start, end=y_end)
+        self.dot_plot.xaxis.ticker = list(range(len(dashboard['cats'])))
+        self.dot_plot.xaxis.major_label_overrides = {i: cat for i, cat in enumerate(dashboard['cats'])}
+
+        counties = list(dashboard['df_top_10_counties_ev_wa']['County'])
+        heatmap_origins = list(cube['origins'])
+        self.cells.data = heatmap_columns(cube, year_range, counties, heatmap_origins)
+        present = self.cells.data['Number of EVs Registered'][~np.isnan(self.cells.data['Number of EVs Registered'])]
+        if len(present):
+            self.mapper.update(low=present.min(), high=present.max())
+        self.heatmap.x_range.factors = heatmap_origins
+        self.heatmap.y_range.factors = counties
+
+        for source, columns in zip(self.violin_sources, violin_columns(histograms, year_range)):
+            source.data = columns
+        self.violin_plot.x_range.update(start=-0.5, end=len(origins) - 0.5)
+        self.violin_plot.xaxis.ticker = list(range(len(origins)))
+        self.violin_plot.xaxis.major_label_overrides = {i: origin for i, origin in enumerate(origins)}
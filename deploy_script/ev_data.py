@@ -0,0 +1,445 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Loading the Electric Vehicle Population Data
+#
+# The dashboard used to start with a plain `pd.read_csv` where pandas had to guess every column type, followed by
+# recasting a handful of columns one at a time (each cast making another copy of that column). Here the types are
+# declared up front in `SCHEMA`, so the CSV is parsed exactly once into the types we want. Those types are also picked
+# to keep the dataframe small: text columns are categories and numbers use int16/uint16 style types where they fit,
+# which matters when several server processes each hold a copy on the same machine.
+#
+# After that first parse, every column is written into a binary cache folder next to `./csv/` as plain numpy `.npy`
+# files. Categories are stored as their integer codes plus the list of distinct values, so nothing needs pickling and
+# every file can be memory mapped. The cache remembers the sha256 hash of the CSV it came from, and is rebuilt whenever the
+# CSV changes. Later server starts skip the CSV entirely and only load the columns the dashboard actually uses.
+#
+# On top of that, `dashboard_data` can keep a snapshot of everything `prepare_dashboard_data` makes in one pickle file,
+# again tied to the sha256 hash of the CSV. Starting from the snapshot skips loading the columns and preparing the data,
+# and a snapshot built ahead of time (for example when the Space is built) also spares the very first start the parse of
+# the CSV. The columns in it are ordinary arrays rather than memory maps though, so every server process started from it
+# holds its own copy.
+#
+# Running this file directly (`python ev_data.py`) builds the cache and reports how long each way of loading takes.
+
+import contextlib
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from ev_aggregates import build_count_cube, build_location_bins, build_range_histograms
+
+try:
+    import fcntl
+except ImportError:
+    ## Windows has no fcntl, there the cache is simply built without a lock
+    fcntl = None
+
+
+CSV_PATH = './csv/Electric_Vehicle_Population_Data.csv'
+CACHE_DIR = './csv_cache'
+
+## Bump this whenever SCHEMA or the cache layout changes, so old caches are thrown away
+CACHE_VERSION = 4
+
+## Where `dashboard_data(snapshot=True)` keeps the prepared data
+SNAPSHOT_PATH = './prepared_snapshot.pickle'
+
+## The type every column is parsed into. Every text column is a category (stored as small integer codes plus one copy of
+## each distinct value), and the numbers use the narrowest type that fits them. Capitalised types are pandas' nullable
+## ints, for columns that have blanks in the csv
+SCHEMA = {
+    'VIN (1-10)': 'category',
+    'County': 'category',
+    'City': 'category',
+    'State': 'category',
+    'Postal Code': 'Int32',
+    'Model Year': 'int16',
+    'Make': 'category',
+    'Model': 'category',
+    'Electric Vehicle Type': 'category',
+    'Clean Alternative Fuel Vehicle (CAFV) Eligibility': 'category',
+    'Electric Range': 'UInt16',
+    'Base MSRP': 'Int32',
+    'Legislative District': 'UInt8',
+    'DOL Vehicle ID': 'int64',
+    'Vehicle Location': 'category',
+    'Electric Utility': 'category',
+    '2020 Census Tract': 'Int64',
+}
+
+## The only columns the `create_*` plot functions (and the origin lookup they depend on) need, plus the DOL's own
+## id for every vehicle, which is how the monthly updates are matched up with the rows we already have
+DASHBOARD_COLUMNS = ['VIN (1-10)', 'County', 'State', 'Model Year', 'Make', 'Electric Vehicle Type', 'Electric Range',
+                     'DOL Vehicle ID', 'Vehicle Location']
+
+## Origin given to any make that is missing from the lookup lists, instead of quietly guessing one
+UNKNOWN_ORIGIN = 'Unknown'
+
+## Makes grouped by the continent the company has its headquarters in (not necessarily where the car is built)
+REGIONS = {
+    'North America': ['TESLA', 'JEEP', 'FORD', 'CHEVROLET', 'RIVIAN', 'CHRYSLER', 'CADILLAC', 'LINCOLN', 'DODGE', 'GMC', 'LUCID', 'FISKER', 'MULLEN AUTOMOTIVE INC.', 'BRIGHTDROP', 'RAM', 'AZURE DYNAMICS', 'WHEEGO ELECTRIC CARS'],
+    'Asia': ['NISSAN', 'KIA', 'HYUNDAI', 'MAZDA', 'TOYOTA', 'SUBARU', 'LEXUS', 'HONDA', 'MITSUBISHI', 'ACURA', 'GENESIS', 'VINFAST'],
+    'Europe': ['FIAT', 'AUDI', 'PORSCHE', 'BMW', 'POLESTAR', 'VOLVO', 'MINI', 'MERCEDES-BENZ', 'VOLKSWAGEN', 'ALFA ROMEO', 'SMART', 'JAGUAR', 'LAND ROVER', 'LAMBORGHINI', 'TH!NK', 'ROLLS-ROYCE', 'BENTLEY'],
+}
+
+## A fixed seed gives every server process the exact same jitter, so the dot plots match whichever process draws them
+JITTER_SEED = 521
+
+
+def file_sha256(path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as source:
+        for block in iter(lambda: source.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_source(csv_path=CSV_PATH, columns=None):
+    ## A single parse of the CSV with every type declared up front, so no column is recast afterwards
+    return pd.read_csv(csv_path, dtype=SCHEMA, usecols=columns)
+
+
+def _column_files(position):
+    return {
+        'values': 'col_{:02d}_values.npy'.format(position),
+        'mask': 'col_{:02d}_mask.npy'.format(position),
+        'categories': 'col_{:02d}_categories.npy'.format(position),
+    }
+
+
+def write_cache(frame, source_hash, cache_dir=CACHE_DIR):
+    ## Everything is written into a temporary folder first and swapped in at the end,
+    ## so a half written cache is never picked up by another server process
+    tmp_dir = '{}.tmp-{}'.format(cache_dir, os.getpid())
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    manifest = {'version': CACHE_VERSION, 'source_sha256': source_hash, 'rows': len(frame), 'columns': {}}
+    for position, column in enumerate(frame.columns):
+        files = _column_files(position)
+        series = frame[column]
+
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            kind = 'category'
+            np.save(os.path.join(tmp_dir, files['values']), series.cat.codes.to_numpy())
+            np.save(os.path.join(tmp_dir, files['categories']), np.asarray(series.cat.categories, dtype=str))
+        elif pd.api.types.is_extension_array_dtype(series.dtype):
+            ## Nullable ints are kept as their plain numpy values plus a separate mask of the blanks
+            kind = 'masked'
+            np.save(os.path.join(tmp_dir, files['values']), series.to_numpy(dtype=series.dtype.numpy_dtype, na_value=0))
+            np.save(os.path.join(tmp_dir, files['mask']), series.isna().to_numpy())
+        else:
+            kind = 'plain'
+            np.save(os.path.join(tmp_dir, files['values']), series.to_numpy())
+
+        manifest['columns'][column] = {'kind': kind, 'position': position}
+
+    with open(os.path.join(tmp_dir, 'manifest.json'), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    os.replace(tmp_dir, cache_dir)
+
+
+def read_manifest(cache_dir=CACHE_DIR):
+    try:
+        with open(os.path.join(cache_dir, 'manifest.json')) as manifest_file:
+            return json.load(manifest_file)
+    except (OSError, ValueError):
+        return None
+
+
+def read_cache(columns, cache_dir=CACHE_DIR):
+    ## Every column stays a read only memory map of its .npy file. The operating system keeps a single copy of those
+    ## pages in memory, so several server processes reading the same cache share it instead of each holding their own
+    manifest = read_manifest(cache_dir)
+    data = {}
+    for column in columns:
+        entry = manifest['columns'][column]
+        files = _column_files(entry['position'])
+        values = np.load(os.path.join(cache_dir, files['values']), mmap_mode='r')
+
+        if entry['kind'] == 'category':
+            categories = np.load(os.path.join(cache_dir, files['categories'])).astype(object)
+            data[column] = pd.Categorical.from_codes(values, categories=categories)
+        elif entry['kind'] == 'masked':
+            mask = np.load(os.path.join(cache_dir, files['mask']), mmap_mode='r')
+            data[column] = pd.arrays.IntegerArray(values, mask)
+        else:
+            data[column] = values
+
+    ## copy=False keeps pandas from gluing the columns together into new (private) arrays
+    return pd.DataFrame(data, columns=columns, copy=False)
+
+
+@contextlib.contextmanager
+def _cache_lock(cache_dir):
+    ## Only one server process at a time gets to (re)build the cache, the others wait and then use its result
+    with open(cache_dir + '.lock', 'w') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        yield
+
+
+def _cache_is_current(manifest, source_hash):
+    return manifest is not None and manifest.get('version') == CACHE_VERSION and manifest.get('source_sha256') == source_hash
+
+
+def load_dataset(columns=DASHBOARD_COLUMNS, csv_path=CSV_PATH, cache_dir=CACHE_DIR):
+    ## Load `columns` from the binary cache, rebuilding the cache from the CSV first if it is missing or out of date
+    columns = list(columns)
+    source_hash = file_sha256(csv_path)
+
+    if not _cache_is_current(read_manifest(cache_dir), source_hash):
+        frame = None
+        try:
+            with _cache_lock(cache_dir):
+                ## Another server process may have rebuilt it while we were waiting for the lock
+                if not _cache_is_current(read_manifest(cache_dir), source_hash):
+                    frame = read_source(csv_path)
+                    write_cache(frame, source_hash, cache_dir)
+        except OSError as error:
+            ## A read only deployment can still serve the dashboard, it just parses the CSV on every start
+            print('Could not write the data cache to {}: {}'.format(cache_dir, error))
+            frame = frame if frame is not None else read_source(csv_path)
+            frame = frame[columns]
+            frame.attrs['source_sha256'] = source_hash
+            return frame
+
+    ## Even right after building the cache, read it back so this process also uses the shared memory maps
+    frame = read_cache(columns, cache_dir)
+
+    ## Lets anything built from this frame know which version of the csv it came from
+    frame.attrs['source_sha256'] = source_hash
+    return frame
+
+
+def derive_origin(makes, regions):
+    ## Vectorized version of the old row by row `region_check`. `regions` maps an origin name to its list of makes.
+    ## The lookup is done once per distinct make (a few dozen) and then spread to every row through the category codes.
+    makes = makes.astype('category')
+    make_origin = {make: origin for origin, region_makes in regions.items() for make in region_makes}
+    origin_labels = list(regions) + [UNKNOWN_ORIGIN]
+
+    lookup = np.array([origin_labels.index(make_origin.get(make, UNKNOWN_ORIGIN)) for make in makes.cat.categories]
+                      + [origin_labels.index(UNKNOWN_ORIGIN)], dtype=np.int8)
+    ## Missing makes have code -1, which picks up the trailing 'Unknown' entry of the lookup
+    origins = pd.Categorical.from_codes(lookup[makes.cat.codes.to_numpy()], categories=origin_labels)
+    return pd.Series(origins, index=makes.index, name='EV Regional Origin').cat.remove_unused_categories()
+
+
+def unknown_makes(makes, origins):
+    ## The makes that `derive_origin` could not place, with how many vehicles each one has
+    unknown = makes[origins == UNKNOWN_ORIGIN]
+    return unknown.value_counts(dropna=False).loc[lambda counts: counts > 0]
+
+
+def memory_report(frame):
+    ## Memory used by every column (strings and category values included), largest first
+    usage = frame.memory_usage(deep=True, index=False)
+    return pd.DataFrame({
+        'dtype': frame.dtypes.astype(str),
+        'MB': usage / 2 ** 20,
+    }).sort_values('MB', ascending=False)
+
+
+# ## Data shared by every dashboard session
+#
+# `panel serve` runs the dashboard script again for every visitor. Everything the plots need from the data is built
+# here once per server process instead, and every session gets the same objects. Those are shared, so sessions must
+# only read from them and never change them in place. The only thing that changes them is a data refresh (see
+# `ev_refresh.py`), which swaps in new entries through `update_dashboard_data`.
+
+_dashboard_data = None
+_dashboard_lock = threading.Lock()
+
+
+def read_snapshot(path=SNAPSHOT_PATH, csv_path=CSV_PATH):
+    ## The prepared data saved by `write_snapshot`, or None when there is none for the current csv. Only ever
+    ## unpickle snapshots this dashboard wrote itself
+    try:
+        with open(path, 'rb') as snapshot_file:
+            snapshot = pickle.load(snapshot_file)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        return None
+    if snapshot.get('version') != CACHE_VERSION or snapshot.get('source_sha256') != file_sha256(csv_path):
+        return None
+    freeze_aggregates(snapshot['data'])
+    return snapshot['data']
+
+
+def write_snapshot(data, path=SNAPSHOT_PATH):
+    ## Written next to the snapshot first and swapped in at the end, like the cache, so no one reads half of it
+    snapshot = {'version': CACHE_VERSION, 'source_sha256': data['version'], 'data': data}
+    tmp_path = '{}.tmp-{}'.format(path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as snapshot_file:
+            pickle.dump(snapshot, snapshot_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except OSError as error:
+        print('Could not write the data snapshot to {}: {}'.format(path, error))
+
+
+def dashboard_data(snapshot=False, streaming=False, workers=1):
+    ## With `snapshot`, the prepared data comes from SNAPSHOT_PATH when that was made from the current csv, and is saved
+    ## there otherwise, for the next start. With `streaming`, the csv is counted block by block in `workers` processes
+    ## instead of being loaded whole (see `ev_ingest.py`)
+    global _dashboard_data
+    with _dashboard_lock:
+        if _dashboard_data is None:
+            data = read_snapshot() if snapshot else None
+            ## Streamed data has no dataframe, so a snapshot of the other kind of data is not used
+            if data is not None and (data['df'] is None) != streaming:
+                data = None
+            if data is None:
+                if streaming:
+                    ## Imported here, since ev_ingest builds on this module
+                    from ev_ingest import stream_dashboard_data
+                    data = stream_dashboard_data(workers=workers)
+                else:
+                    data = prepare_dashboard_data(load_dataset(DASHBOARD_COLUMNS))
+                if snapshot:
+                    write_snapshot(data)
+            _dashboard_data = data
+        return _dashboard_data
+
+
+def set_dashboard_data(data):
+    ## Use `data` (from `prepare_dashboard_data`) instead of loading the csv, e.g. a synthetic dataset for benchmarking
+    global _dashboard_data
+    freeze_aggregates(data)
+    with _dashboard_lock:
+        _dashboard_data = data
+
+
+def update_dashboard_data(data):
+    ## Every session holds on to the same dict, so the new entries are swapped into it rather than replacing it
+    freeze_aggregates(data)
+    with _dashboard_lock:
+        _dashboard_data.update(data)
+
+
+def freeze_aggregates(data):
+    ## The aggregate arrays are shared by every session, so make sure nothing writes into them by accident
+    for name in ('ev_count_cube', 'range_histograms', 'location_bins'):
+        for value in data.get(name, {}).values():
+            if isinstance(value, np.ndarray):
+                value.setflags(write=False)
+
+
+def prepare_dashboard_data(df):
+    df['EV Regional Origin'] = derive_origin(df['Make'], REGIONS)
+
+    ## Any make that is not in one of the REGIONS lists is labelled 'Unknown', so it is easy to spot and add to the right list
+    unknown = unknown_makes(df['Make'], df['EV Regional Origin'])
+    if len(unknown):
+        print('Makes with no regional origin yet:', unknown.to_dict())
+
+    ## Vehicles with a range of 0 are missing their range, so the dot and violin plots leave them out
+    violin__dot_df = df[df['Electric Range'] > 0].copy()
+    cats = violin__dot_df['Electric Vehicle Type'].astype('category').cat.categories
+    violin__dot_df['Electric Vehicle Type Code'] = violin__dot_df['Electric Vehicle Type'].astype('category').cat.codes
+    jitter = np.random.default_rng(JITTER_SEED).normal(0, 0.05, len(violin__dot_df))
+    violin__dot_df['Jitter'] = violin__dot_df['Electric Vehicle Type Code'] + jitter
+
+    dot_plot_sizes = violin__dot_df['EV Regional Origin'].value_counts().to_dict()
+    dot_plot_sizes['All'] = len(violin__dot_df)
+
+    df_wa_counties = df[df['State'] == 'WA']
+    df_top_10_counties_ev_wa = df_wa_counties.groupby('County', observed=True).agg({'VIN (1-10)': 'count'}).nlargest(10, 'VIN (1-10)')
+    df_top_10_counties_ev_wa = df_top_10_counties_ev_wa.reset_index(inplace=False)
+
+    data = {
+        ## Changes whenever the rows do, so sessions and the plot cache can tell their plots are out of date
+        'version': df.attrs['source_sha256'],
+        'df': df,
+        'origins': list(df['EV Regional Origin'].unique()),
+        'violin__dot_df': violin__dot_df,
+        'cats': cats,
+        'max_range': int(violin__dot_df['Electric Range'].max()),
+        'dot_plot_sizes': dot_plot_sizes,
+        'df_top_10_counties_ev_wa': df_top_10_counties_ev_wa,
+        'ev_count_cube': build_count_cube(df),
+        'range_histograms': build_range_histograms(violin__dot_df),
+        'location_bins': build_location_bins(df),
+    }
+    freeze_aggregates(data)
+    return data
+
+
+def _peak_rss_mb():
+    ## Highest resident memory of this process since it started or since the mark was last reset (Linux only)
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024
+
+
+def _measure(func, *args):
+    ## Runs `func` inside a fresh process and returns its time and peak memory. On Linux a new process starts out with
+    ## the peak memory of the one that started it, so the mark is reset to what this process holds right now first. Any
+    ## worker processes `func` starts count with the largest of them
+    import resource
+    with open('/proc/self/clear_refs', 'w') as clear_refs:
+        clear_refs.write('5')
+    start = time.perf_counter()
+    func(*args)
+    seconds = time.perf_counter() - start
+    return seconds, max(_peak_rss_mb(), resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024)
+
+
+def _plain_read_csv():
+    ## The old startup: inferred types, then the columns recast one at a time
+    frame = pd.read_csv(CSV_PATH)
+    for column in ['State', 'Electric Vehicle Type', 'Clean Alternative Fuel Vehicle (CAFV) Eligibility']:
+        frame[column] = frame[column].astype('category')
+    for column in ['Postal Code', 'Electric Range', 'Legislative District']:
+        frame[column] = frame[column].astype('Int64')
+
+
+def _cached_load():
+    load_dataset(DASHBOARD_COLUMNS)
+
+
+def _cached_load_and_prepare():
+    prepare_dashboard_data(load_dataset(DASHBOARD_COLUMNS))
+
+
+def _snapshot_load():
+    read_snapshot()
+
+
+def _imports_only():
+    ## What every measuring process holds before loading anything, for comparison
+    pass
+
+
+def _write_cache_and_snapshot():
+    write_cache(read_source(CSV_PATH), file_sha256(CSV_PATH))
+    write_snapshot(prepare_dashboard_data(load_dataset(DASHBOARD_COLUMNS)))
+
+
+if __name__ == '__main__':
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    ## Everything is loaded in processes of their own, and this one only reads the data once every measurement is done
+    loaders = [('imports only', _imports_only), ('typed parse + cache/snapshot', _write_cache_and_snapshot),
+               ('plain read_csv + casts', _plain_read_csv),
+               ('cached dashboard columns', _cached_load), ('cached columns + prepare', _cached_load_and_prepare),
+               ('prepared snapshot', _snapshot_load)]
+    for name, loader in loaders:
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+            seconds, peak_mb = pool.submit(_measure, loader).result()
+        print('{:<30} {:6.2f}s  peak RSS {:7.1f} MB'.format(name + ':', seconds, peak_mb))
+
+    print()
+    print(memory_report(load_dataset(SCHEMA)))
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Streaming ingest for extracts that do not fit in memory
+#
+# `load_dataset` reads every row of the csv into one dataframe. That is fine for Washington, but a multi-state extract
+# with tens of millions of vehicles would not fit. Apart from the dot plot, though, the dashboard never looks at the rows
+# themselves, only at the aggregates built from them: the count cube behind the bar plot and the heatmap (and the top
+# 10 counties), and the range histograms behind the violin plot. Those counts add up, so they can be built one part of
+# the csv at a time and merged (see the end of `ev_aggregates.py`).
+#
+# `stream_dashboard_data` cuts the csv into blocks of about `BLOCK_BYTES` at line breaks, parses one block at a time
+# with the same `SCHEMA`, counts it into its own cube and histograms, and merges those into the running totals before
+# moving on, so the whole table never exists at once. With `workers` above 1 the blocks are parsed and counted in
+# that many processes, and merged in the order they appear in the file.
+#
+# The dot plot does draw single vehicles, so it gets a uniform random sample of at most `DOT_SAMPLE_SIZE` of them:
+# every vehicle draws a random key (seeded by the block it is in), and only the vehicles with the smallest keys are
+# kept from block to block. That way the sample is the same however many processes count the blocks. Everything in
+# memory is bounded by the size of a block, the sample and the (small) aggregates, not by the number of rows. The memory
+# freed after each block is handed back to the system straight away, since glibc would otherwise keep it for later and
+# the process would keep growing block after block.
+#
+# Blocks are cut at line breaks, so the csv must not have any inside quoted fields, which the DOL's export does not.
+#
+# Running this file directly (`python ev_ingest.py`) checks the result against `prepare_dashboard_data` and measures
+# the time and peak memory of the streaming ingest on extracts made up of more and more copies of the csv.
+
+import ctypes
+import ctypes.util
+import io
+import multiprocessing
+import os
+
+import numpy as np
+import pandas as pd
+
+from ev_aggregates import build_count_cube, build_location_bins, build_range_histograms, cube_top_counties
+from ev_aggregates import merge_count_cubes, merge_location_bins, merge_range_histograms
+from ev_data import CACHE_DIR, CSV_PATH, DASHBOARD_COLUMNS, JITTER_SEED, REGIONS, SCHEMA, UNKNOWN_ORIGIN
+from ev_data import derive_origin, file_sha256, freeze_aggregates, unknown_makes
+
+
+BLOCK_BYTES = 32 << 20
+DOT_SAMPLE_SIZE = 250_000
+
+## The columns the dot plot sample keeps, besides the jitter worked out at the end
+SAMPLE_COLUMNS = ['Model Year', 'Electric Vehicle Type', 'Electric Range', 'EV Regional Origin']
+
+## Every origin `derive_origin` can give, in the order it lists them
+ORIGIN_LABELS = list(REGIONS) + [UNKNOWN_ORIGIN]
+
+
+def csv_blocks(csv_path=CSV_PATH, block_bytes=BLOCK_BYTES):
+    ## (start, end) byte offsets of blocks of about `block_bytes` each, every one starting at the beginning of a line,
+    ## after the header
+    size = os.path.getsize(csv_path)
+    blocks = []
+    with open(csv_path, 'rb') as source:
+        source.readline()
+        start = source.tell()
+        while start < size:
+            source.seek(min(start + block_bytes, size))
+            ## Carry on to the end of the line the cut falls in (readline at the end of the file reads nothing)
+            source.readline()
+            end = max(source.tell(), start + 1) if start + block_bytes < size else size
+            blocks.append((start, end))
+            start = end
+    return blocks
+
+
+def read_block(csv_path, start, end, columns=DASHBOARD_COLUMNS):
+    ## Parses the rows between the two offsets into the same types `load_dataset` gives them
+    header = pd.read_csv(csv_path, nrows=0).columns
+    with open(csv_path, 'rb') as source:
+        source.seek(start)
+        data = source.read(end - start)
+    return pd.read_csv(io.BytesIO(data), header=None, names=header, usecols=columns,
+                       dtype={column: SCHEMA[column] for column in columns})
+
+
+def _smallest_keys(sample, sample_size):
+    ## The `sample_size` rows with the smallest keys, in the order they are in the csv
+    if len(sample) > sample_size:
+        sample = sample.iloc[np.argpartition(sample['key'].to_numpy(), sample_size)[:sample_size]]
+    return sample.sort_values('row', kind='stable')
+
+
+def block_aggregates(csv_path, block, index, sample_size=DOT_SAMPLE_SIZE):
+    ## Everything `stream_dashboard_data` needs from block number `index` of the csv
+    frame = read_block(csv_path, *block)
+    frame['EV Regional Origin'] = derive_origin(frame['Make'], REGIONS)
+
+    ## Same filter as `prepare_dashboard_data`: vehicles with a range of 0 are missing their range, and so are the ones
+    ## with a blank range
+    has_range = (frame['Electric Range'] > 0).to_numpy(dtype=bool, na_value=False)
+    dots = frame[has_range]
+    rng = np.random.default_rng([JITTER_SEED, index])
+    sample = dots[SAMPLE_COLUMNS].astype({'Electric Vehicle Type': object, 'EV Regional Origin': object})
+    sample = sample.assign(row=np.flatnonzero(has_range), key=rng.random(len(sample)),
+                           noise=rng.normal(0, 0.05, len(sample)))
+
+    return {
+        'rows': len(frame),
+        'ev_count_cube': build_count_cube(frame),
+        'range_histograms': build_range_histograms(dots),
+        'location_bins': build_location_bins(frame),
+        'dot_rows': len(dots),
+        'vehicle_types': set(frame['Electric Vehicle Type'].dropna()),
+        'max_range': int(dots['Electric Range'].max()) if len(dots) else 0,
+        'unknown_makes': unknown_makes(frame['Make'], frame['EV Regional Origin']),
+        'sample': _smallest_keys(sample, sample_size),
+    }
+
+
+def _release_freed_memory():
+    ## Returns the memory glibc has kept after the last block's dataframes were freed. Does nothing without glibc
+    try:
+        ctypes.CDLL(ctypes.util.find_library('c')).malloc_trim(0)
+    except (OSError, AttributeError, TypeError):
+        pass
+
+
+def _block_aggregates(job):
+    aggregates = block_aggregates(*job)
+    _release_freed_memory()
+    return aggregates
+
+
+def merge_block_aggregates(total, part, sample_size=DOT_SAMPLE_SIZE):
+    ## `total` covers every block before `part`, so the rows of `part` are numbered on from there
+    sample = part['sample'].assign(row=part['sample']['row'] + total['rows'])
+    return {
+        'rows': total['rows'] + part['rows'],
+        'ev_count_cube': merge_count_cubes(total['ev_count_cube'], part['ev_count_cube']),
+        'range_histograms': merge_range_histograms(total['range_histograms'], part['range_histograms']),
+        'location_bins': merge_location_bins(total['location_bins'], part['location_bins']),
+        'dot_rows': total['dot_rows'] + part['dot_rows'],
+        'vehicle_types': total['vehicle_types'] | part['vehicle_types'],
+        'max_range': max(total['max_range'], part['max_range']),
+        'unknown_makes': total['unknown_makes'].add(part['unknown_makes'], fill_value=0).astype(np.int64),
+        'sample': _smallest_keys(pd.concat([total['sample'], sample]), sample_size),
+    }
+
+
+def stream_aggregates(csv_path=CSV_PATH, block_bytes=BLOCK_BYTES, sample_size=DOT_SAMPLE_SIZE, workers=1):
+    ## The merged aggregates of every block of the csv, counted in `workers` processes
+    jobs = [(csv_path, block, index, sample_size) for index, block in enumerate(csv_blocks(csv_path, block_bytes))]
+    ## Spawned rather than forked, since a server process has threads running (the metrics server, the background import)
+    pool = multiprocessing.get_context('spawn').Pool(workers) if workers > 1 else None
+    total = None
+    try:
+        ## imap hands the blocks back in order, while the other processes already work on the next ones
+        for part in (pool.imap(_block_aggregates, jobs) if pool is not None else map(_block_aggregates, jobs)):
+            total = part if total is None else merge_block_aggregates(total, part, sample_size)
+            _release_freed_memory()
+    finally:
+        if pool is not None:
+            pool.terminate()
+    if total is None:
+        raise ValueError('{} has no rows'.format(csv_path))
+    return total
+
+
+def stream_dashboard_data(csv_path=CSV_PATH, block_bytes=BLOCK_BYTES, sample_size=DOT_SAMPLE_SIZE, workers=1):
+    ## The same dictionary as `prepare_dashboard_data`, without ever holding every row. There is no 'df', and the dot
+    ## plot draws the sample in 'violin__dot_df' (every vehicle, while there are no more than `sample_size`)
+    totals = stream_aggregates(csv_path, block_bytes, sample_size, workers)
+    ev_count_cube = totals['ev_count_cube']
+
+    if len(totals['unknown_makes']):
+        print('Makes with no regional origin yet:', totals['unknown_makes'].to_dict())
+
+    sample = totals['sample']
+    cats = pd.Index(sorted(totals['vehicle_types']))
+    violin__dot_df = pd.DataFrame({
+        'Model Year': sample['Model Year'].to_numpy(),
+        'Electric Vehicle Type': pd.Categorical(sample['Electric Vehicle Type'], categories=cats),
+        'Electric Range': sample['Electric Range'].to_numpy(),
+        'EV Regional Origin': pd.Categorical(sample['EV Regional Origin'],
+                                             categories=[origin for origin in ORIGIN_LABELS if origin in ev_count_cube['origins']]),
+    })
+    violin__dot_df['Electric Vehicle Type Code'] = violin__dot_df['Electric Vehicle Type'].cat.codes
+    violin__dot_df['Jitter'] = violin__dot_df['Electric Vehicle Type Code'] + sample['noise'].to_numpy()
+
+    dot_plot_sizes = violin__dot_df['EV Regional Origin'].value_counts().to_dict()
+    dot_plot_sizes['All'] = len(violin__dot_df)
+
+    ## Origins in the order they first show up in the csv, like `unique()` on the whole column
+    origin_first_row = ev_count_cube['first_row'].min(axis=(0, 2))
+    origins = [ev_count_cube['origins'][i] for i in np.argsort(origin_first_row, kind='stable')
+               if origin_first_row[i] < np.iinfo(np.int64).max]
+
+    data = {
+        'version': file_sha256(csv_path),
+        ## The rows are never held all at once, so there is no dataframe of them
+        'df': None,
+        'rows': totals['rows'],
+        'origins': origins,
+        'violin__dot_df': violin__dot_df,
+        'cats': cats,
+        'max_range': totals['max_range'],
+        'dot_plot_sizes': dot_plot_sizes,
+        'df_top_10_counties_ev_wa': cube_top_counties(ev_count_cube),
+        'ev_count_cube': ev_count_cube,
+        'range_histograms': totals['range_histograms'],
+        'location_bins': totals['location_bins'],
+    }
+    freeze_aggregates(data)
+    return data
+
+
+def _same_as_in_memory(csv_path=CSV_PATH, cache_dir=CACHE_DIR):
+    ## Every aggregate the plots read has to come out exactly as `prepare_dashboard_data` makes it
+    from ev_data import load_dataset, prepare_dashboard_data
+
+    expected = prepare_dashboard_data(load_dataset(DASHBOARD_COLUMNS, csv_path, cache_dir))
+    for workers in (1, 3):
+        ## Small blocks, so the csv is cut into plenty of them
+        streamed = stream_dashboard_data(csv_path, block_bytes=1 << 20, workers=workers)
+        for name in ('ev_count_cube', 'range_histograms', 'location_bins'):
+            for key, value in expected[name].items():
+                assert np.array_equal(np.asarray(value), np.asarray(streamed[name][key])), (name, key)
+        ## The counties come out as plain strings here, like the top 10 after a refresh (see `ev_refresh.py`)
+        assert expected['df_top_10_counties_ev_wa'].values.tolist() == streamed['df_top_10_counties_ev_wa'].values.tolist()
+        assert expected['origins'] == streamed['origins']
+        assert list(expected['cats']) == list(streamed['cats'])
+        assert expected['max_range'] == streamed['max_range']
+        if len(expected['violin__dot_df']) <= DOT_SAMPLE_SIZE:
+            assert expected['dot_plot_sizes'] == streamed['dot_plot_sizes']
+        print('{}, workers={}: same aggregates as the in memory data'.format(os.path.basename(csv_path), workers))
+
+
+def _with_blank_ranges(csv_path, target, every=97):
+    ## A copy of the csv with the range of every `every`th vehicle left blank, which the DOL's csv has for some vehicles
+    frame = pd.read_csv(csv_path, dtype=str, keep_default_na=False)
+    frame.loc[::every, 'Electric Range'] = ''
+    frame.to_csv(target, index=False)
+
+
+if __name__ == '__main__':
+    import argparse
+    import shutil
+    import tempfile
+    from concurrent.futures import ProcessPoolExecutor
+    from ev_data import _measure
+
+    parser = argparse.ArgumentParser(description='Checks and measures the streaming ingest of the csv.')
+    parser.add_argument('--copies', type=int, nargs='+', default=[1, 4, 16],
+                        help='sizes of the made up extracts, as a number of copies of the csv')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='ev-ingest-')
+    try:
+        ## Measured first, each in a process of its own, and the extracts are copied over without reading them into this
+        ## process, which only loads the whole csv for the checks at the end
+        for copies in args.copies:
+            ## The rows of the csv again and again under one header, standing in for a multi-state extract
+            extract = os.path.join(work_dir, 'extract-{}.csv'.format(copies))
+            with open(CSV_PATH, 'rb') as source, open(extract, 'wb') as target:
+                target.write(source.readline())
+                body_start = source.tell()
+                source.seek(-1, os.SEEK_END)
+                ends_with_newline = source.read(1) == b'\n'
+                for _ in range(copies):
+                    source.seek(body_start)
+                    shutil.copyfileobj(source, target)
+                    if not ends_with_newline:
+                        target.write(b'\n')
+            size_mb = os.path.getsize(extract) / 1e6
+
+            for workers in sorted({1, args.workers}):
+                with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as measure:
+                    seconds, peak_mb = measure.submit(_measure, stream_dashboard_data, extract, BLOCK_BYTES, DOT_SAMPLE_SIZE, workers).result()
+                print('{:6.0f} MB csv, {:2d} worker(s): {:6.2f}s  peak RSS {:7.1f} MB'.format(size_mb, workers, seconds, peak_mb))
+            os.remove(extract)
+
+        _same_as_in_memory()
+        ## With a cache of its own, so the cache of the real csv is left alone
+        blank_ranges = os.path.join(work_dir, 'blank-ranges.csv')
+        _with_blank_ranges(CSV_PATH, blank_ranges)
+        _same_as_in_memory(blank_ranges, os.path.join(work_dir, 'csv_cache'))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
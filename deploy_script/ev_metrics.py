@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Timing the dashboard callbacks
+#
+# When the dashboard feels slow, the time can go into four different places: working out the numbers (`data_prep`,
+# pandas and the aggregates), making the hvplot/HoloViews object (`plot_build`), Panel turning that object into Bokeh
+# models on the session's event loop (`render`), and Bokeh encoding the changed models into the message that goes
+# down the websocket (`serialization`).
+#
+# Each `create_*` function is wrapped with `@timed_callback`, which records its `total` time (cache hits included),
+# and marks its two halves with `with phase('data_prep'):` / `with phase('plot_build'):`. The last two phases happen
+# after the function has returned, so they are picked up from Bokeh itself: `PATCH-DOC`, the message type Bokeh sends
+# every model update in, is replaced with a subclass that times its own encoding and measures its size, and charges
+# both to the callback whose result is being applied.
+#
+# Everything is counted into latency and payload histograms, which `start_metrics_server` serves in the Prometheus text
+# format at `http://127.0.0.1:<port>/metrics`, together with the number of open sessions and the plot cache counters.
+# Each server process serves its own numbers, on the first free port from the one asked for.
+#
+# With `set_profile_threshold(seconds)`, any callback slower than that also leaves a cProfile dump in `./profiles/`,
+# which can be opened with `python -m pstats` or snakeviz.
+#
+# How long the first session of a server process took to get going is kept as well (`record_startup`), step by step:
+# the imports, the data, the page around the plots and the first four plots, each counted from the start of the script.
+# Those are the numbers a visitor waking up a sleeping server feels, and they are printed once and served as gauges.
+
+import contextlib
+import contextvars
+import cProfile
+import functools
+import os
+import threading
+import time
+import weakref
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import panel as pn
+from bokeh.protocol import SPEC
+from bokeh.protocol.messages.patch_doc import patch_doc
+
+import ev_cache
+
+
+## Upper edges of the histogram buckets, in seconds and in bytes
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+PAYLOAD_BUCKETS = (1e3, 1e4, 1e5, 2.5e5, 1e6, 2.5e6, 1e7)
+
+PROFILE_DIR = './profiles'
+
+_histograms = {}
+_lock = threading.Lock()
+_sessions = {'live': 0, 'total': 0}
+_profile_threshold = None
+
+## Seconds into the first session of this server process at which each startup step was done
+_startup = {}
+## The callbacks the first session is still waiting on for its first plots (see `time_first_plots`)
+_first_plots = {'started': None, 'waiting': set()}
+
+## The callback running in this thread (set by `timed_callback`)
+_callback = contextvars.ContextVar('ev_callback', default=None)
+
+## For every session's document, the callbacks whose results Panel is applying and when they came back, oldest first,
+## so the next Bokeh messages for that document can be charged to them. Documents of closed sessions drop out on their own
+_pending = weakref.WeakKeyDictionary()
+
+
+def _observe(name, labels, value, buckets):
+    with _lock:
+        histogram = _histograms.get((name, labels))
+        if histogram is None:
+            histogram = _histograms[(name, labels)] = {'buckets': buckets, 'counts': np.zeros(len(buckets) + 1, dtype=np.int64),
+                                                       'sum': 0.0}
+        histogram['counts'][np.searchsorted(buckets, value)] += 1
+        histogram['sum'] += value
+
+
+def record_latency(callback, phase_name, seconds):
+    _observe('ev_callback_seconds', (('callback', callback), ('phase', phase_name)), seconds, LATENCY_BUCKETS)
+
+
+def record_payload(callback, size):
+    _observe('ev_update_payload_bytes', (('callback', callback),), size, PAYLOAD_BUCKETS)
+
+
+@contextlib.contextmanager
+def phase(name):
+    ## Times the block as phase `name` of whichever `@timed_callback` function it runs in
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        callback = _callback.get()
+        if callback is not None:
+            record_latency(callback, name, time.perf_counter() - start)
+
+
+def set_profile_threshold(seconds, directory=PROFILE_DIR):
+    ## Callbacks slower than `seconds` get profiled into `directory`. None turns the profiler off again
+    global _profile_threshold, PROFILE_DIR
+    _profile_threshold = seconds
+    PROFILE_DIR = directory
+
+
+def record_startup(step, seconds):
+    ## Only the first time counts, later sessions find everything imported and loaded already
+    with _lock:
+        if step in _startup:
+            return
+        _startup[step] = seconds
+    print('Cold start: {} done after {:.2f}s'.format(step, seconds))
+
+
+def time_first_plots(started, names):
+    ## Records the `plots` step once every callback in `names` has come back (see `callback_returned`)
+    with _lock:
+        if 'plots' in _startup or _first_plots['waiting']:
+            return
+        _first_plots.update(started=started, waiting=set(names))
+
+
+def timed_callback(func):
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        token = _callback.set(name)
+        ## cProfile only follows the thread it was started in, which is the one running this callback
+        profiler = cProfile.Profile() if _profile_threshold is not None else None
+        start = time.perf_counter()
+        try:
+            if profiler is None:
+                return func(*args, **kwargs)
+            return profiler.runcall(func, *args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - start
+            _callback.reset(token)
+            record_latency(name, 'total', seconds)
+            callback_returned(name)
+            if profiler is not None and seconds > _profile_threshold:
+                _dump_profile(profiler, name, seconds)
+
+    return wrapper
+
+
+def callback_returned(name):
+    ## Only does something on the event loop (the main thread under `panel serve`), where Panel applies the result.
+    ## Worker threads can see another session's document, so `in_background` calls this again once the result is back
+    if threading.current_thread() is not threading.main_thread():
+        return
+    with _lock:
+        waiting = _first_plots['waiting']
+        first_plots_done = name in waiting and len(waiting) == 1
+        waiting.discard(name)
+    if first_plots_done:
+        record_startup('plots', time.perf_counter() - _first_plots['started'])
+
+    doc = pn.state.curdoc
+    if doc is not None:
+        with _lock:
+            _pending.setdefault(doc, deque(maxlen=8)).append((name, time.perf_counter()))
+
+
+def _dump_profile(profiler, name, seconds):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, '{}-{}-{:.0f}ms.prof'.format(name, time.strftime('%Y%m%d-%H%M%S'), seconds * 1000))
+    profiler.dump_stats(path)
+    print('Profiled slow callback {} ({:.2f}s) into {}'.format(name, seconds, path))
+
+
+class timed_patch_doc(patch_doc):
+    ## Bokeh builds one of these for every batch of model changes it sends to a browser
+
+    @classmethod
+    def create(cls, events, **metadata):
+        ## Only the first message after a callback is charged to it, anything after that is other traffic
+        with _lock:
+            pending = _pending.get(events[0].document)
+            callback, returned = pending.popleft() if pending else ('other', None)
+        start = time.perf_counter()
+        msg = super().create(events, **metadata)
+        ## content_json is kept on the message, so working it out here saves Bokeh doing it again when sending
+        size = len(msg.header_json) + len(msg.metadata_json) + len(msg.content_json) + sum(memoryview(buffer.data).nbytes for buffer in msg.buffers)
+        seconds = time.perf_counter() - start
+
+        if returned is not None:
+            record_latency(callback, 'render', start - returned)
+        record_latency(callback, 'serialization', seconds)
+        record_payload(callback, size)
+        return msg
+
+
+def track_session():
+    ## Counts this session as open once its page has loaded, and as closed again when it goes away
+    def opened():
+        with _lock:
+            _sessions['live'] += 1
+            _sessions['total'] += 1
+            ## The plots built while the page was first made went out with the whole page, not in a message of their own.
+            ## Outside of a server (a notebook, or a script running the dashboard) there is no document at all
+            if pn.state.curdoc is not None:
+                _pending.pop(pn.state.curdoc, None)
+        pn.state.on_session_destroyed(lambda session_context: closed())
+
+    def closed():
+        with _lock:
+            _sessions['live'] -= 1
+
+    pn.state.onload(opened)
+
+
+def metrics_text():
+    ## Everything in the Prometheus text format
+    lines = []
+    with _lock:
+        histograms = sorted(_histograms.items())
+        sessions = dict(_sessions)
+        startup = dict(_startup)
+
+    seen = set()
+    for (name, labels), histogram in histograms:
+        if name not in seen:
+            lines.append('# TYPE {} histogram'.format(name))
+            seen.add(name)
+        label_text = ','.join('{}="{}"'.format(key, value) for key, value in labels)
+        cumulative = np.cumsum(histogram['counts'])
+        for edge, count in zip(list(histogram['buckets']) + ['+Inf'], cumulative):
+            lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, label_text, edge, count))
+        lines.append('{}_sum{{{}}} {}'.format(name, label_text, histogram['sum']))
+        lines.append('{}_count{{{}}} {}'.format(name, label_text, cumulative[-1]))
+
+    lines += ['# TYPE ev_active_sessions gauge', 'ev_active_sessions {}'.format(sessions['live']),
+              '# TYPE ev_sessions_total counter', 'ev_sessions_total {}'.format(sessions['total'])]
+
+    lines.append('# TYPE ev_cold_start_seconds gauge')
+    lines += ['ev_cold_start_seconds{{step="{}"}} {}'.format(step, seconds) for step, seconds in startup.items()]
+
+    stats = ev_cache.cache_stats()
+    for column in ('hits', 'misses', 'evictions'):
+        lines.append('# TYPE ev_plot_cache_{}_total counter'.format(column))
+        lines += ['ev_plot_cache_{}_total{{function="{}"}} {}'.format(column, function, count)
+                  for function, count in stats[column].items()]
+    return '\n'.join(lines) + '\n'
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics_text().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        ## Scrapes every few seconds would drown out the server's own log
+        pass
+
+
+_server = None
+_server_lock = threading.Lock()
+
+
+def start_metrics_server(port=9464, host='127.0.0.1', tries=16):
+    ## Starts (once per server process) the metrics route, and puts the timed PATCH-DOC in place. Returns the port used
+    global _server
+    with _server_lock:
+        if _server is None:
+            for candidate in range(port, port + tries):
+                try:
+                    _server = ThreadingHTTPServer((host, candidate), _MetricsHandler)
+                    break
+                except OSError:
+                    continue
+            else:
+                print('No free port for the metrics server between {} and {}'.format(port, port + tries - 1))
+                return None
+            SPEC['PATCH-DOC'] = timed_patch_doc
+            threading.Thread(target=_server.serve_forever, name='ev-metrics', daemon=True).start()
+            print('Dashboard metrics at http://{}:{}/metrics'.format(host, _server.server_address[1]))
+        return _server.server_address[1]
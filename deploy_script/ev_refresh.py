@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Applying the monthly DOL update without restarting the server
+#
+# The DOL republishes the Electric Vehicle Population Data every month. Most vehicles in it are the same as last
+# month: a few thousand are newly registered, some have changed (moved county, corrected range, ...) and some have been
+# deregistered. Every vehicle has a `DOL Vehicle ID`, so the new csv is matched up against the rows we already have by
+# that id, which gives the delta: the rows to insert or update and the ids that are gone.
+#
+# `apply_delta` then only works on those rows. The regional origin and the jitter are worked out for the new rows only,
+# the count cube, range histograms and dot plot sizes have the old rows taken out and the new ones counted in (see the
+# end of `ev_aggregates.py`), and the top 10 counties come straight from the patched cube. The rows kept from before keep
+# their jitter, so dots do not jump around between updates. The only steps that touch every row are the hash lookup of
+# the ids and gluing the kept rows to the new ones, both plain vectorized copies.
+#
+# `start_refresh_watcher` checks the csv in the background every so often. Once it changes, the update is applied to
+# the data every session shares and the plot cache is moved to the new version. Each open dashboard notices the new
+# version on its next check and redraws its plots, so nobody has to reload the page or restart the server.
+#
+# Running this file directly (`python ev_refresh.py`) makes up a monthly update for the current csv and times applying
+# it against building everything from scratch.
+
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+import ev_cache
+from ev_aggregates import build_location_bins, cube_top_counties, merge_location_bins, update_count_cube, update_range_histograms
+from ev_data import CSV_PATH, DASHBOARD_COLUMNS, JITTER_SEED, REGIONS
+from ev_data import dashboard_data, derive_origin, file_sha256, read_source, unknown_makes, update_dashboard_data
+from ev_ingest import stream_dashboard_data
+
+
+ID_COLUMN = 'DOL Vehicle ID'
+
+
+def diff_snapshot(current, snapshot, columns=DASHBOARD_COLUMNS):
+    ## Matches a freshly published csv (`snapshot`) against the rows we have by their DOL id. Returns the rows that are
+    ## new or changed (as they are in the snapshot) and the ids of the vehicles that are no longer registered
+    current_ids = pd.Index(current[ID_COLUMN])
+    snapshot_ids = pd.Index(snapshot[ID_COLUMN])
+    removed_ids = current_ids.difference(snapshot_ids).to_numpy()
+
+    position = current_ids.get_indexer(snapshot_ids)
+    known = position >= 0
+    changed = ~known
+
+    old_rows = current.iloc[position[known]].reset_index(drop=True)
+    new_rows = snapshot[known].reset_index(drop=True)
+    for column in columns:
+        if column != ID_COLUMN:
+            changed[known] |= ~_same_values(old_rows[column], new_rows[column])
+
+    return snapshot[changed], removed_ids
+
+
+def _same_values(old, new):
+    ## Row by row equality where two blanks count as the same
+    if isinstance(old.dtype, pd.CategoricalDtype) and isinstance(new.dtype, pd.CategoricalDtype):
+        ## The two frames usually have different categories, so the old codes are translated into the new ones first.
+        ## A value the new frame has no category for gets -2, which never matches anything
+        translate = new.cat.categories.get_indexer(old.cat.categories)
+        translate = np.append(np.where(translate >= 0, translate, -2), -1)
+        return translate[old.cat.codes.to_numpy()] == new.cat.codes.to_numpy()
+    same = (old == new).to_numpy(dtype=bool, na_value=False)
+    return same | (old.isna() & new.isna()).to_numpy()
+
+
+def _append_categories(kept, new_values):
+    ## Only the new values are looked up in the existing categories, and any value not seen before becomes a new
+    ## category at the end, so the codes of the kept rows stay as they are
+    categories = kept.cat.categories
+    new_values = pd.Series(new_values, dtype=object)
+    codes = categories.get_indexer(new_values)
+    unseen = pd.Index(new_values[(codes < 0) & new_values.notna().to_numpy()].unique())
+    dtype = kept.dtype
+    if len(unseen):
+        dtype = pd.CategoricalDtype(categories.append(unseen))
+        codes[codes < 0] = dtype.categories.get_indexer(new_values[codes < 0])
+    return pd.Categorical.from_codes(np.concatenate([kept.cat.codes.to_numpy(), codes]), dtype=dtype, validate=False)
+
+
+def _splice_rows(frame, drop, new_rows):
+    ## `frame` without the rows at positions `drop`, with `new_rows` added at the end. Category columns stay categories
+    keep = np.ones(len(frame), dtype=bool)
+    keep[drop] = False
+    columns = {}
+    for column in frame.columns:
+        kept = frame[column][keep]
+        if isinstance(kept.dtype, pd.CategoricalDtype):
+            columns[column] = _append_categories(kept, new_rows[column])
+        else:
+            columns[column] = pd.concat([kept, new_rows[column].astype(kept.dtype)], ignore_index=True)
+    return pd.DataFrame(columns, columns=frame.columns)
+
+
+def _row_positions(frame, ids):
+    positions = pd.Index(frame[ID_COLUMN]).get_indexer(ids)
+    return positions[positions >= 0]
+
+
+def _max_range(histograms):
+    ## Largest range that still has a vehicle, read off the last bin with a count in it
+    totals = histograms['count_prefix'][-1].sum(axis=0)
+    present = np.flatnonzero(totals > 0)
+    return int(histograms['values'][present[-1]] + (histograms['bin_width'] - 1) / 2) if len(present) else 0
+
+
+def apply_delta(data, upserts, removed_ids, version):
+    ## Returns the entries of `prepare_dashboard_data` that change when `upserts` are inserted or replace the rows with
+    ## the same DOL id, and the vehicles with `removed_ids` are deregistered
+    df = data['df']
+    upserts = upserts[DASHBOARD_COLUMNS].reset_index(drop=True)
+    upserts['EV Regional Origin'] = derive_origin(upserts['Make'], REGIONS)
+    unknown = unknown_makes(upserts['Make'], upserts['EV Regional Origin'])
+    if len(unknown):
+        print('Makes with no regional origin yet:', unknown.to_dict())
+    gone_ids = np.concatenate([np.asarray(removed_ids, dtype=np.int64), upserts[ID_COLUMN].to_numpy(dtype=np.int64)])
+
+    ## Old versions of the changed rows go out together with the deregistered ones
+    drop = _row_positions(df, gone_ids)
+    old_rows = df.iloc[drop]
+
+    dot_df = data['violin__dot_df']
+    dot_drop = _row_positions(dot_df, gone_ids)
+    old_dots = dot_df.iloc[dot_drop]
+
+    cats = data['cats']
+    new_dots = upserts[upserts['Electric Range'] > 0].copy()
+    cats = cats.append(pd.Index(new_dots['Electric Vehicle Type'].dropna().unique()).difference(cats))
+    new_dots['Electric Vehicle Type Code'] = cats.get_indexer(new_dots['Electric Vehicle Type']).astype(np.int8)
+    ## Seeded with the version, so every server process applying the same update gives the new dots the same jitter
+    rng = np.random.default_rng([JITTER_SEED, int(version[:16], 16)])
+    new_dots['Jitter'] = new_dots['Electric Vehicle Type Code'] + rng.normal(0, 0.05, len(new_dots))
+
+    dot_plot_sizes = dict(data['dot_plot_sizes'])
+    for rows, sign in ((old_dots, -1), (new_dots, 1)):
+        for origin, count in rows['EV Regional Origin'].value_counts().items():
+            dot_plot_sizes[origin] = dot_plot_sizes.get(origin, 0) + sign * count
+    dot_plot_sizes['All'] += len(new_dots) - len(old_dots)
+
+    ev_count_cube = update_count_cube(data['ev_count_cube'], old_rows, upserts)
+    range_histograms = update_range_histograms(data['range_histograms'], old_dots, new_dots)
+    location_bins = merge_location_bins(merge_location_bins(data['location_bins'], build_location_bins(upserts)),
+                                        build_location_bins(old_rows), sign=-1)
+
+    df = _splice_rows(df, drop, upserts)
+    df.attrs['source_sha256'] = version
+    origins = list(data['origins'])
+    origins += [origin for origin in upserts['EV Regional Origin'].unique() if origin not in origins]
+
+    return {
+        'version': version,
+        'df': df,
+        'origins': origins,
+        'violin__dot_df': _splice_rows(dot_df, dot_drop, new_dots),
+        'cats': cats,
+        'max_range': _max_range(range_histograms),
+        'dot_plot_sizes': dot_plot_sizes,
+        'df_top_10_counties_ev_wa': cube_top_counties(ev_count_cube),
+        'ev_count_cube': ev_count_cube,
+        'range_histograms': range_histograms,
+        'location_bins': location_bins,
+    }
+
+
+def refresh_dashboard(csv_path=CSV_PATH):
+    ## Applies whatever changed in the csv to the shared dashboard data. Returns the number of inserted or updated rows
+    ## and of deregistered vehicles, or None if the csv is still the one the data came from (or the data was streamed)
+    data = dashboard_data()
+    version = file_sha256(csv_path)
+    if version == data['version']:
+        return None
+
+    if data['df'] is None:
+        ## Data streamed in by `ev_ingest.py` has no rows to match the new csv against, so it is counted again instead.
+        ## This runs in the watcher's thread, so one process is enough
+        streamed = stream_dashboard_data(csv_path)
+        update_dashboard_data(streamed)
+        ev_cache.set_data_version(version)
+        print('Counted the new csv again ({} rows)'.format(streamed['rows']))
+        return None
+
+    upserts, removed_ids = diff_snapshot(data['df'], read_source(csv_path, columns=DASHBOARD_COLUMNS))
+    update_dashboard_data(apply_delta(data, upserts, removed_ids, version))
+
+    ## The data is swapped in first, so a plot built from the old data can no longer end up cached under the new version
+    ev_cache.set_data_version(version)
+    return len(upserts), len(removed_ids)
+
+
+_watcher = None
+_watcher_lock = threading.Lock()
+
+
+def _stat(csv_path):
+    try:
+        stat = os.stat(csv_path)
+        return stat.st_mtime, stat.st_size
+    except OSError:
+        return None
+
+
+def _watch(csv_path, interval):
+    ## The watcher starts right after the data was loaded, so the csv as it is now counts as already applied
+    last_seen = _stat(csv_path)
+    while True:
+        time.sleep(interval)
+        try:
+            stat = _stat(csv_path)
+            if stat is not None and stat != last_seen:
+                start = time.perf_counter()
+                changes = refresh_dashboard(csv_path)
+                if changes is not None:
+                    print('Applied data update ({} inserted or updated, {} deregistered) in {:.2f}s'.format(
+                        *changes, time.perf_counter() - start))
+                last_seen = stat
+        except Exception as error:
+            ## A half copied csv or a bad row should not stop the watcher, it tries again on the next check
+            print('Could not apply the data update from {}: {}'.format(csv_path, error))
+
+
+def start_refresh_watcher(interval=15 * 60, csv_path=CSV_PATH):
+    ## Starts (once per server process) a background thread that checks the csv every `interval` seconds
+    global _watcher
+    with _watcher_lock:
+        if _watcher is None:
+            _watcher = threading.Thread(target=_watch, args=(csv_path, interval), name='ev-refresh', daemon=True)
+            _watcher.start()
+
+
+def _fake_update(frame, changed, seed=0):
+    ## A made up monthly update: `changed` vehicles get deregistered, as many get a new county and as many new ones are
+    ## registered (copies of existing rows under new ids)
+    rng = np.random.default_rng(seed)
+    snapshot = frame[DASHBOARD_COLUMNS].copy()
+    picks = rng.choice(len(snapshot), 3 * changed, replace=False)
+    gone, moved, copied = picks[:changed], picks[changed:2 * changed], picks[2 * changed:]
+
+    counties = snapshot['County'].cat.categories
+    snapshot.iloc[moved, snapshot.columns.get_loc('County')] = rng.choice(counties, changed)
+    new_rows = snapshot.iloc[copied].copy()
+    new_rows[ID_COLUMN] = snapshot[ID_COLUMN].max() + 1 + np.arange(changed)
+    return pd.concat([snapshot.drop(snapshot.index[gone]), new_rows], ignore_index=True)
+
+
+if __name__ == '__main__':
+    from ev_aggregates import cube_county_origin_counts, histogram_counts, location_bin_counts
+    from ev_data import prepare_dashboard_data
+
+    data = dashboard_data()
+    print('{} rows'.format(len(data['df'])))
+
+    ## Without the delta, picking up a new csv means parsing all of it and building everything again
+    start = time.perf_counter()
+    frame = read_source(CSV_PATH, columns=DASHBOARD_COLUMNS)
+    frame.attrs['source_sha256'] = file_sha256(CSV_PATH)
+    prepare_dashboard_data(frame)
+    print('parse csv + rebuild everything: {:6.3f}s'.format(time.perf_counter() - start))
+
+    for changed in (100, 1000, 10000):
+        snapshot = _fake_update(data['df'], changed)
+        version = '{:064x}'.format(changed)
+
+        start = time.perf_counter()
+        upserts, removed_ids = diff_snapshot(data['df'], snapshot)
+        diff_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        patched = apply_delta(data, upserts, removed_ids, version)
+        apply_seconds = time.perf_counter() - start
+
+        ## The patched aggregates have to give the same numbers as the ones built from scratch
+        snapshot.attrs['source_sha256'] = version
+        rebuilt = prepare_dashboard_data(snapshot)
+        years = (int(rebuilt['ev_count_cube']['years'][0]), int(rebuilt['ev_count_cube']['years'][-1]))
+        counties = rebuilt['df_top_10_counties_ev_wa']['County']
+        same = (
+            patched['df_top_10_counties_ev_wa']['VIN (1-10)'].tolist() == rebuilt['df_top_10_counties_ev_wa']['VIN (1-10)'].tolist()
+            and cube_county_origin_counts(patched['ev_count_cube'], years, counties).sort_index().sort_index(axis=1).equals(
+                cube_county_origin_counts(rebuilt['ev_count_cube'], years, counties).sort_index().sort_index(axis=1))
+            and (histogram_counts(patched['range_histograms'], years).sum(axis=0)
+                 == histogram_counts(rebuilt['range_histograms'], years).sum(axis=0)).all()
+            and patched['dot_plot_sizes'] == rebuilt['dot_plot_sizes']
+            and np.array_equal(location_bin_counts(patched['location_bins'], years, 'All'),
+                               location_bin_counts(rebuilt['location_bins'], years, 'All'))
+        )
+        print('{:>6} changed vehicles: diff {:6.3f}s, apply delta {:6.3f}s, same aggregates as a rebuild: {}'.format(
+            changed, diff_seconds, apply_seconds, same))
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Starting the dashboard quickly
+#
+# The Hugging Face Space goes to sleep when nobody has looked at the dashboard for a while, and the next visitor waits
+# for the server to start, the imports, the data and the first four plots before seeing anything. `panel serve`
+# has imported Panel and Bokeh by the time it runs `introduction.py`, and with the data cache in place loading the data
+# takes a fraction of a second, so most of what is left is importing hvplot and HoloViews, which only the plots need.
+#
+# `import_plotting` starts that import in a background thread and returns a stand in for `holoviews` (the `hv` in
+# `introduction.py`), so the rest of the script, the widgets and the page around the plots can be put together in the
+# meantime. Using anything of `hv`, or `DataFrame.hvplot`, waits for the import to finish first. The plots themselves
+# are only built once the page has loaded in the browser (`defer_load`), which is usually long after the import is done.
+#
+# Running this file directly (`python ev_startup.py`) times the imports both ways.
+
+import atexit
+import importlib
+import sys
+import threading
+
+import pandas as pd
+
+import ev_cache
+
+
+class background_import:
+    ## Stands in for the module `name`, which is imported (after everything in `first`) in a thread straight away.
+    ## The first attribute looked up on it waits for that thread
+    def __init__(self, name, first=()):
+        self._name = name
+        self._thread = threading.Thread(target=self._run, args=(list(first) + [name],), name='ev-import', daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def _run(names):
+        for name in names:
+            try:
+                importlib.import_module(name)
+            except Exception:
+                ## Importing it again in `wait` raises the same error, in the thread that needs the module
+                return
+
+    def wait(self):
+        self._thread.join()
+        return importlib.import_module(self._name)
+
+    def __getattr__(self, attribute):
+        return getattr(self.wait(), attribute)
+
+
+def import_plotting():
+    ## Returns `holoviews`, or a stand in for it while it and hvplot.pandas are imported in the background
+    if 'hvplot.pandas' in sys.modules:
+        ## Already imported earlier in this process (another session, or a script running the dashboard again)
+        return importlib.import_module('holoviews')
+
+    ## hvplot.pandas puts its own `.hvplot` on DataFrames when it is imported, this one only covers the time until then
+    def hvplot_once_imported(frame):
+        hv.wait()
+        return frame.hvplot
+
+    pd.DataFrame.hvplot = property(hvplot_once_imported)
+    hv = background_import('holoviews', first=['hvplot.pandas'])
+    ## HoloViews now comes after the plot cache, so at exit it is torn down first and every cached plot would complain
+    ## about that as it goes. Emptying the cache before then keeps the exit quiet
+    atexit.register(ev_cache.clear)
+    return hv
+
+
+if __name__ == '__main__':
+    import subprocess
+
+    ## Each way in a fresh interpreter, as it would be on a cold start. Panel is imported first, like `panel serve` does
+    ways = {
+        'import hvplot.pandas':  'import hvplot.pandas\nimport holoviews as hv',
+        'import_plotting()': 'from ev_startup import import_plotting\nhv = import_plotting()',
+    }
+    for name, code in ways.items():
+        script = ('import time, panel\nstart = time.perf_counter()\n' + code +
+                  '\nready = time.perf_counter()\nhv.Curve\nprint(ready - start, time.perf_counter() - start)')
+        seconds = [float(number) for number in subprocess.check_output([sys.executable, '-W', 'ignore', '-c', script]).split()]
+        print('{:<22} script carries on after {:5.2f}s, hv usable after {:5.2f}s'.format(name + ':', *seconds))
@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# # Exporting every widget state as a static site
+#
+# The dashboard only ever shows a limited number of different plots: one bar plot and dot plot per choice of the
+# dropdown, and one heatmap and violin plot per year range the slider can be set to. The two widgets never affect each
+# other's plots, so there is no need to go through every combination of the two, just through the choices of each.
+#
+# This renders all of those plots ahead of time into a folder that any static host can serve, with no Python running
+# behind it: an `index.html` with the dropdown, the two ends of the year range and BokehJS, and a `figures/` folder with
+# every plot as gzipped Bokeh JSON. Picking a value in the page fetches the plots for it (once, after that they are kept
+# in the page) and draws them with BokehJS.
+#
+# Plots that come out exactly the same for different widget values (for example year ranges that only differ by years
+# nobody registered a vehicle from) are stored once. Bokeh gives every model a new id each time it renders, so the ids
+# are renumbered in the order they appear before two plots are compared.
+#
+# There are n * (n + 1) / 2 year ranges for n slider stops, so with many model years the count grows quickly. With
+# `--year-step` the slider moves that many years at a time, and `--max-year-ranges` picks the smallest step that keeps
+# the number of ranges under the limit. Rendering takes most of the build time, so `--workers` spreads it over several
+# processes (forked from the one that loaded the data, so Linux and macOS only).
+#
+# The dot plot is exported the way it first shows up, so zooming in the static page does not redraw the density image
+# for the zoomed in part like the server does. Run `python ev_static.py` next to `./csv/`, the same way the dashboard
+# is served, and serve the folder it makes with any web server (`python -m http.server -d static_export` to try it out;
+# browsers do not let a page opened straight from disk fetch the plots).
+
+import argparse
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+
+
+EXPORT_DIR = './static_export'
+YEAR_STEP = 1
+
+## Which plots each widget drives, in the order they are laid out on the page
+WIDGET_PLOTS = {
+    'ev_origin': ('create_barplot', 'create_dot_plot'),
+    'year_range': ('create_heatmap', 'create_violin_plot'),
+}
+
+_BOKEH_ID = re.compile(r'"(p\d{4,})"')
+
+## The loaded dashboard, for the forked worker processes to render from
+_session = None
+
+
+def slider_stops(first, last, step=YEAR_STEP):
+    ## The years the slider can stop at, `step` years apart. The last year is always one of them
+    stops = list(range(first, last + 1, step))
+    if stops[-1] != last:
+        stops.append(last)
+    return stops
+
+
+def year_ranges(stops):
+    return [(lo, hi) for i, lo in enumerate(stops) for hi in stops[i:]]
+
+
+def coarsest_step_needed(first, last, max_year_ranges):
+    ## The smallest step that keeps the number of year ranges at or below `max_year_ranges`
+    step = 1
+    while len(year_ranges(slider_stops(first, last, step))) > max_year_ranges and step <= last - first:
+        step += 1
+    return step
+
+
+def figure_json(plot):
+    ## The plot as Bokeh JSON, with the model ids renumbered so the same plot always comes out the same
+    import holoviews as hv
+    from bokeh.embed import json_item
+
+    ## json_item warns about the Python callbacks of the dot plot's zoom stream, which do nothing in a static page anyway
+    logging.getLogger('bokeh.embed.util').setLevel(logging.ERROR)
+    text = json.dumps(json_item(hv.render(plot, backend='bokeh')), sort_keys=True, separators=(',', ':'))
+    ids = {}
+    return _BOKEH_ID.sub(lambda match: '"{}"'.format(ids.setdefault(match.group(1), 'p{}'.format(1000 + len(ids)))), text)
+
+
+def render_state(job):
+    widget, key, value = job
+    return widget, key, [figure_json(_session[name](**{widget: value})) for name in WIDGET_PLOTS[widget]]
+
+
+class FigureStore:
+    ## Writes every distinct figure once into `directory`, named after a hash of its JSON
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.sizes = {}
+        self.rendered = 0
+        self.raw_bytes = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def add(self, text):
+        data = text.encode()
+        name = hashlib.sha256(data).hexdigest()[:16]
+        self.rendered += 1
+        self.raw_bytes += len(data)
+        if name not in self.sizes:
+            ## mtime=0 keeps the files the same from one build to the next, so unchanged plots do not need uploading again
+            compressed = gzip.compress(data, compresslevel=9, mtime=0)
+            with open(os.path.join(self.directory, name + '.json.gz'), 'wb') as output:
+                output.write(compressed)
+            self.sizes[name] = len(compressed)
+        return name
+
+    def remove_unused(self):
+        ## Figures left over from an earlier build
+        for filename in os.listdir(self.directory):
+            if filename.endswith('.json.gz') and filename[:-len('.json.gz')] not in self.sizes:
+                os.remove(os.path.join(self.directory, filename))
+
+
+def export_static(session, output=EXPORT_DIR, year_step=YEAR_STEP, max_year_ranges=None, inline=False, workers=1):
+    ## `session` is the namespace of a run of introduction.py, which has the plot functions and the widgets in it
+    global _session
+    _session = session
+    start = time.perf_counter()
+    select, slider = session['select_var_ev_origin'], session['year_range_slider']
+    first, last = int(slider.start), int(slider.end)
+    if max_year_ranges is not None:
+        year_step = max(year_step, coarsest_step_needed(first, last, max_year_ranges))
+    stops = slider_stops(first, last, year_step)
+
+    states = {
+        'ev_origin': [(origin, origin) for origin in select.options],
+        'year_range': [('{}-{}'.format(lo, hi), (lo, hi)) for lo, hi in year_ranges(stops)],
+    }
+    jobs = [(widget, key, value) for widget in WIDGET_PLOTS for key, value in states[widget]]
+    store = FigureStore(os.path.join(output, 'figures'))
+    figures = {widget: {} for widget in WIDGET_PLOTS}
+    if workers > 1:
+        import multiprocessing
+        pool = multiprocessing.get_context('fork').Pool(workers)
+        rendered = pool.imap(render_state, jobs, chunksize=8)
+    else:
+        pool, rendered = None, map(render_state, jobs)
+    try:
+        for widget, key, texts in rendered:
+            figures[widget][key] = [store.add(text) for text in texts]
+    finally:
+        if pool is not None:
+            pool.close()
+    store.remove_unused()
+
+    manifest = {
+        'origins': list(select.options),
+        'origin': select.value,
+        'years': stops,
+        'year_range': [max(int(slider.value[0]), first), min(int(slider.value[1]), last)],
+        'figures': figures,
+    }
+    with open(os.path.join(output, 'index.html'), 'w') as page:
+        page.write(static_page(manifest, inline))
+
+    bundle_bytes = sum(os.path.getsize(os.path.join(folder, filename))
+                       for folder, _, filenames in os.walk(output) for filename in filenames)
+    return {
+        'year_step': year_step,
+        'states': {widget: len(values) for widget, values in states.items()},
+        'figures_rendered': store.rendered,
+        'figures_stored': len(store.sizes),
+        'figure_json_bytes': store.raw_bytes,
+        'figure_gzip_bytes': sum(store.sizes.values()),
+        'bundle_bytes': bundle_bytes,
+        'workers': workers,
+        'build_seconds': time.perf_counter() - start,
+    }
+
+
+def static_page(manifest, inline=False):
+    from bokeh.resources import CDN, INLINE
+
+    ## `</` could end the script tag the manifest sits in
+    manifest_json = json.dumps(manifest, separators=(',', ':')).replace('</', '<\\/')
+    return (_PAGE.replace('{{bokeh_js}}', (INLINE if inline else CDN).render_js())
+                 .replace('{{manifest}}', manifest_json))
+
+
+_PAGE = '''<!DOCTYPE html>
+<html lang="en">
+<head>
+<meta charset="utf-8">
+<title>Electric Vehicle Registration data for the State of Washington</title>
+{{bokeh_js}}
+<style>
+  body { font-family: sans-serif; margin: 1em 2em; }
+  h1 { font-size: 4em; color: black; }
+  h3 { font-size: 1.5em; color: black; }
+  .plots { display: flex; flex-wrap: wrap; gap: 1em; }
+  .years input { width: 300px; display: block; }
+</style>
+</head>
+<body>
+<h1>Electric Vehicle Registration data for the State of Washington</h1>
+<h3>Use the following dropdown to filter for EV Model Origin in the 2 plots below</h3>
+<select id="ev-origin" title="Choose which Regional HQ Location You would like to focus on"></select>
+<div class="plots"><div id="create_barplot"></div><div id="create_dot_plot"></div></div>
+<h3>Use the following slider to filter for EV Model Years in the 2 plots below</h3>
+<div class="years">
+  <label>Model Years: <span id="year-label"></span></label>
+  <input type="range" id="year-from" min="0" step="1">
+  <input type="range" id="year-to" min="0" step="1">
+</div>
+<div class="plots"><div id="create_heatmap"></div><div id="create_violin_plot"></div></div>
+<script type="application/json" id="ev-manifest">{{manifest}}</script>
+<script>
+const manifest = JSON.parse(document.getElementById('ev-manifest').textContent);
+const plots = {ev_origin: ['create_barplot', 'create_dot_plot'], year_range: ['create_heatmap', 'create_violin_plot']};
+const loaded = new Map();
+const shown = {};
+const requested = {};
+
+function load_figure(name) {
+  if (!loaded.has(name)) {
+    loaded.set(name, fetch('figures/' + name + '.json.gz').then(async (response) => {
+      let bytes = new Uint8Array(await response.arrayBuffer());
+      // Some hosts unzip .gz files on the way, in which case the gzip header is gone
+      if (bytes[0] == 0x1f && bytes[1] == 0x8b) {
+        const stream = new Blob([bytes]).stream().pipeThrough(new DecompressionStream('gzip'));
+        bytes = new Uint8Array(await new Response(stream).arrayBuffer());
+      }
+      return JSON.parse(new TextDecoder().decode(bytes));
+    }));
+  }
+  return loaded.get(name);
+}
+
+function show(widget, key) {
+  manifest.figures[widget][key].forEach(async (name, i) => {
+    const target = plots[widget][i];
+    requested[target] = name;
+    const item = await load_figure(name);
+    // A later choice may have come in while this one was loading
+    if (requested[target] != name || shown[target]?.name == name) return;
+    shown[target]?.views.clear();
+    shown[target] = {name: name, views: await Bokeh.embed.embed_item(item, target)};
+  });
+}
+
+const select = document.getElementById('ev-origin');
+for (const origin of manifest.origins) select.add(new Option(origin, origin, false, origin == manifest.origin));
+select.addEventListener('change', () => show('ev_origin', select.value));
+
+const year_from = document.getElementById('year-from');
+const year_to = document.getElementById('year-to');
+const years = manifest.years;
+function year_range() {
+  return [years[Math.min(year_from.value, year_to.value)], years[Math.max(year_from.value, year_to.value)]];
+}
+function label_years() {
+  const [lo, hi] = year_range();
+  document.getElementById('year-label').textContent = lo + ' - ' + hi;
+}
+for (const [input, year] of [[year_from, manifest.year_range[0]], [year_to, manifest.year_range[1]]]) {
+  input.max = years.length - 1;
+  input.value = years.findIndex((stop) => stop >= year);
+  // Like value_throttled, the plots only change once the handle is let go
+  input.addEventListener('input', label_years);
+  input.addEventListener('change', () => show('year_range', year_range().join('-')));
+}
+
+label_years();
+show('ev_origin', select.value);
+show('year_range', year_range().join('-'));
+</script>
+</body>
+</html>
+'''
+
+
+if __name__ == '__main__':
+    import runpy
+    import warnings
+
+    parser = argparse.ArgumentParser(description='Render every widget state of the dashboard into a static site.')
+    parser.add_argument('--output', default=EXPORT_DIR)
+    parser.add_argument('--year-step', type=int, default=YEAR_STEP, help='years between the stops of the slider')
+    parser.add_argument('--max-year-ranges', type=int, help='coarsen the slider until there are at most this many year ranges')
+    parser.add_argument('--inline', action='store_true', help='put BokehJS in the page instead of loading it from the Bokeh CDN')
+    parser.add_argument('--workers', type=int, default=1, help='processes to render the figures in')
+    args = parser.parse_args()
+
+    warnings.filterwarnings('ignore')
+    start = time.perf_counter()
+    session = runpy.run_path(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'introduction.py'))
+    load_seconds = time.perf_counter() - start
+
+    report = export_static(session, args.output, args.year_step, args.max_year_ranges, args.inline, args.workers)
+    report['load_seconds'] = load_seconds
+    with open(os.path.join(args.output, 'build_report.json'), 'w') as output:
+        json.dump(report, output, indent=2)
+
+    print('Year step {}: {:,d} origin and {:,d} year range states, {:,d} figures rendered, {:,d} stored'.format(
+        report['year_step'], report['states']['ev_origin'], report['states']['year_range'],
+        report['figures_rendered'], report['figures_stored']))
+    print('Figures {:.1f} MB as JSON, {:.1f} MB gzipped, whole bundle {:.1f} MB'.format(
+        report['figure_json_bytes'] / 1e6, report['figure_gzip_bytes'] / 1e6, report['bundle_bytes'] / 1e6))
+    print('Loading the dashboard took {:.1f}s, rendering every state {:.1f}s. Saved to {}'.format(
+        load_seconds, report['build_seconds'], args.output))
@@ -82,28 +82,62 @@
 # In[1]:
 
 
-import pandas as pd
-import seaborn as sns
+import time
+started = time.perf_counter()
+
 import numpy as np
-import matplotlib.pyplot as plt
-from scipy.stats import zscore
-import hvplot.pandas 
-import holoviews as hv
-from bokeh.models import LogTicker, FuncTickFormatter, FixedTicker, CustomJSTickFormatter
+from bokeh.models import FixedTicker, CustomJSTickFormatter
 import panel as pn 
+from ev_cache import cached, cache_stats, set_data_version
+from ev_callbacks import in_background, plot_build
+from ev_client import ClientSidePlots
+from ev_metrics import timed_callback, phase, track_session, start_metrics_server, set_profile_threshold
+from ev_metrics import record_startup, time_first_plots
+from ev_refresh import start_refresh_watcher
+from ev_data import dashboard_data, memory_report, REGIONS
+from ev_aggregates import cube_year_totals, cube_year_counts, cube_county_origin_counts, density_grid
+from ev_aggregates import histogram_violins, violin_accuracy, location_bin_counts, location_grid
+from ev_startup import import_plotting
+
+## hvplot and HoloViews are only needed once the plots get built, so they are imported in the background while the
+## rest of the page is put together (see `ev_startup.py`). `hv` and `.hvplot` wait for that import the first time they are used
+hv = import_plotting()
 
 pn.extension()
+record_startup('imports', time.perf_counter() - started)
 
 
 # ## <ins>Demonstration</ins>
 
 # <br></br>
 # The first thing I started doing was just checking out the dataset and cleaning it up a little bit. I used pandas to convert the csv file into a dataframe.
+# 
+# Under `panel serve`, this whole script runs again for every visitor, so reading and preparing the data here would be repeated for each of them. Instead, all of the data preparation described below happens once per server process in `dashboard_data()`, and each session just picks up the prepared (read only) results. The loaded columns are memory mapped from the cache, so several server processes on the same machine share one copy of them.
+# 
+# For the deployed dashboard, the csv is parsed once with every column type declared up front (see `SCHEMA` in `ev_data.py`) and saved to a binary cache in `./csv_cache/`. Every start after that loads only the columns the plots need straight from the cache, and the cache is rebuilt automatically whenever the csv file changes.
+# 
+# A csv with more vehicles than fit in memory (say, a registration extract for many states) can still be shown with `STREAMING_INGEST` on. The csv is then read and counted one block at a time, optionally in several processes, and only the counts the plots need are kept, plus a random sample of vehicles for the dot plot (see `ev_ingest.py`). The memory this takes stays the same however big the csv gets.
+# 
+# With `WARM_START_SNAPSHOT` on, everything prepared below is also saved in one file, and a server starting up picks it up from there instead of loading and preparing it again, as long as the csv has not changed since. Made ahead of time (running `python ev_data.py` makes one), it also spares the very first start of a fresh server reading the csv.
+# 
+# The DOL updates this dataset every month, and a running server picks that up on its own (see `ev_refresh.py`). Because of that, the plot functions below always look up what they need in `dashboard` when they are called instead of holding on to it, so they draw from the latest data.
 
 # In[2]:
 
 
-df = pd.read_csv('./csv/Electric_Vehicle_Population_Data.csv')
+## Set to True to start from (and keep) a snapshot of the prepared data in ./prepared_snapshot.pickle, see `ev_data.py`
+WARM_START_SNAPSHOT = False
+## Set to True to count the csv block by block (in INGEST_WORKERS processes) instead of loading it whole, see `ev_ingest.py`
+STREAMING_INGEST = False
+INGEST_WORKERS = 1
+
+## Everything the plots need is built once per server process and shared by every session (see `dashboard_data` in `ev_data.py`)
+dashboard = dashboard_data(snapshot=WARM_START_SNAPSHOT, streaming=STREAMING_INGEST, workers=INGEST_WORKERS)
+record_startup('data', time.perf_counter() - started)
+df = dashboard['df']
+
+## Plots saved in the shared cache are only reused while the csv they came from stays the same
+set_data_version(dashboard['version'])
 
 
 # Next I checked column types and wanted to see how many unique values are in some of these columns. I was be able to convert some of the columns to categories instead of strings/objects for better performance. Also, some of my columns conversions were for clarity and made more intuitive sense. As an example, I thought postal code made more sense as an Int rather than a float, even though it did not end up being used
@@ -111,53 +145,48 @@ df = pd.read_csv('./csv/Electric_Vehicle_Population_Data.csv')
 # In[3]:
 
 
-## How I checked column types
-df.dtypes
+## How I checked column types (streamed data has no dataframe to check)
+df.dtypes if df is not None else None
+
+## How much memory each column takes up
+# memory_report(df)
 
 ## Examples of how I checked for unique values to determine categories
-df['Clean Alternative Fuel Vehicle (CAFV) Eligibility'].unique()
-df['Electric Vehicle Type'].unique()
-df['Make'].unique()
-df['State'].unique()
-df['Clean Alternative Fuel Vehicle (CAFV) Eligibility'].unique()
+# df['Clean Alternative Fuel Vehicle (CAFV) Eligibility'].unique()
+# df['Electric Vehicle Type'].unique()
+# df['Make'].unique()
+# df['State'].unique()
+# df['Clean Alternative Fuel Vehicle (CAFV) Eligibility'].unique()
 
 ## Leave one line above uncommented, while others are commented, in order to see different outputs below from running the cell
 
 
-# Actual column conversion took place below
+# Actual column conversion used to take place below, one column at a time after the csv was read. These types are now part of `SCHEMA` in `ev_data.py`, so the columns come out of `load_dataset` already converted:
+# 
+# <li>`State`, `Electric Vehicle Type` and `Clean Alternative Fuel Vehicle (CAFV) Eligibility` as categories</li>
+# <li>`Postal Code`, `Electric Range` and `Legislative District` as nullable Ints</li>
 
-# In[4]:
 
+# Since I knew I wanted to take a look at vehicle origins. I manually created lists of the makes for each major continental region (North America, Asia, Europe). I originally ran a function on each row of my dataframe using the apply method of the dataframe to check which list each car make was in. Since `Make` is now a category, `derive_origin` (in `ev_data.py`) only has to look up each distinct make once and then hands the region to every row through the category codes, assigning it to a new column, `EV Reional Origin`. Makes that are not in any of the lists are marked as 'Unknown' rather than being lumped in with Europe.
 
-df['State'] = df['State'].astype('category')
-df['Electric Vehicle Type'] = df['Electric Vehicle Type'].astype('category')
-df['Clean Alternative Fuel Vehicle (CAFV) Eligibility'] = df['Clean Alternative Fuel Vehicle (CAFV) Eligibility'].astype('category')
-df['Postal Code'] = df['Postal Code'].astype('Int64')
-df['Electric Range'] = df['Electric Range'].astype('Int64')
-df['Legislative District'] = df['Legislative District'].astype('Int64')
+# In[5]:
 
 
-# Since I knew I wanted to take a look at vehicle origins. I manually created lists of the makes for each major continental region (North America, Asia, Europe). I ran a function on each row of my dataframe using the apply method of the dataframe. This allowed me to do a check of each car make using a custom function and see which list it is in. From there, I return the region and assign it to a new column, `EV Reional Origin`.
+## The lists of makes for each region live in `REGIONS` in `ev_data.py`, and `prepare_dashboard_data` adds the column
+REGIONS
 
-# In[5]:
+## To check the new column now appears
+# df.head()
 
 
-north_america = ['TESLA', 'JEEP', 'FORD', 'CHEVROLET', 'RIVIAN', 'CHRYSLER', 'CADILLAC', 'LINCOLN', 'DODGE', 'GMC', 'LUCID', 'FISKER', 'MULLEN AUTOMOTIVE INC.', 'BRIGHTDROP', 'RAM', 'AZURE DYNAMICS', 'WHEEGO ELECTRIC CARS']
-asia = ['NISSAN', 'KIA', 'HYUNDAI', 'MAZDA', 'TOYOTA', 'SUBARU', 'LEXUS', 'HONDA', 'MITSUBISHI', 'ACURA', 'GENESIS', 'VINFAST']
-europe = ['FIAT', 'AUDI', 'PORSCHE', 'BMW', 'POLESTAR', 'VOLVO', 'MINI', 'MERCEDES-BENZ', 'VOLKSWAGEN', 'ALFA ROMEO', 'SMART', 'JAGUAR', 'LAND ROVER', 'LAMBORGHINI', 'TH!NK', 'ROLLS-ROYCE', 'BENTLEY']
-def region_check(car_make):
-    if car_make in north_america:
-        return 'North America'
-    elif car_make in asia:
-        return 'Asia'
-    else:
-        return 'Europe'
+# ### Count Cube
 
+# Both the bar plot and the heatmap only ever show counts of vehicles by `Model Year`, `EV Regional Origin` and `County`. Rather than running a new groupby over the whole dataframe every time a widget changes, I count every combination of those three columns once here and keep cumulative sums along the model year (see `ev_aggregates.py`). Any origin selection or `year_range` is then answered by slicing that small array, which gives exactly the same numbers as the pandas groupby/pivot_table did.
 
-df['EV Regional Origin'] = df['Make'].apply(region_check)
+# In[ ]:
 
-## To check the new column now appears
-# df.head()
+
+ev_count_cube = dashboard['ev_count_cube']
 
 
 # ### Bar Plot
@@ -170,37 +199,39 @@ df['EV Regional Origin'] = df['Make'].apply(region_check)
 # In[6]:
 
 
+@timed_callback
+@cached
 def create_barplot(ev_origin):
-    miny = 0
-    maxy = df.groupby('Model Year')['VIN (1-10)'].count().sort_values(ascending=False).iloc[0]
-    first_filter = df[df['EV Regional Origin'] == ev_origin] if ev_origin != 'All' else df
-    filtered_df = first_filter.groupby('Model Year').agg({'VIN (1-10)':'count'})
-    filtered_df.reset_index(inplace=True)
-    filtered_df.rename(columns={'VIN (1-10)': 'Number of EVs'}, inplace=True)
-    filtered_df.head()
-    hv_bar_plot = filtered_df.hvplot.bar(x='Model Year', 
-                                        y='Number of EVs', 
-                                        C='Count', 
-                                        cmap='BuPu', 
-                                        xlabel='Model Year', 
-                                        ylabel='Number of Registered EVs (Log Scale)', 
-                                        title='Number of Registered EVs in WA Per Model Year',
-                                        logy=True).opts(
-                                            show_grid=True,
-                                            xlim=(min(df['Model Year']) - 2, max(df['Model Year']) + 2),
-                                            ylim=(2, maxy)
-                                        )
-
-    textbox = hv.Text(
-        x=2001, y=120,
-        text='*Unit increase in Y = 10× more EVs'
-    ).opts(
-        text_align='left',
-        text_font_size='10pt',
-        bgcolor='white'
-    )
+    with phase('data_prep'):
+        ev_count_cube = dashboard['ev_count_cube']
+        miny = 0
+        maxy = cube_year_totals(ev_count_cube).max()
+        filtered_df = cube_year_counts(ev_count_cube, ev_origin)
+
+    with plot_build():
+        hv_bar_plot = filtered_df.hvplot.bar(x='Model Year', 
+                                            y='Number of EVs', 
+                                            C='Count', 
+                                            cmap='BuPu', 
+                                            xlabel='Model Year', 
+                                            ylabel='Number of Registered EVs (Log Scale)', 
+                                            title='Number of Registered EVs in WA Per Model Year',
+                                            logy=True).opts(
+                                                show_grid=True,
+                                                xlim=(ev_count_cube['years'][0] - 2, ev_count_cube['years'][-1] + 2),
+                                                ylim=(2, maxy)
+                                            )
+
+        textbox = hv.Text(
+            x=2001, y=120,
+            text='*Unit increase in Y = 10× more EVs'
+        ).opts(
+            text_align='left',
+            text_font_size='10pt',
+            bgcolor='white'
+        )
 
-    return (hv_bar_plot * textbox)
+        return (hv_bar_plot * textbox)
 
 
 # A couple things of note here. Knowing that I wanted this plot to be interactive, I passed in this parameter of `ev_origin`. This was passed in from the selection of the widget dropdown that I created later. So every time the widget makes a selection, and this function is called again, we have to filter our dataframe (using boolean masking) for the proper EV Origin. I added an `All` selection as well, and if this is selected, we won't filter our dataframe.
@@ -220,37 +251,109 @@ def create_barplot(ev_origin):
 # In[7]:
 
 
-## Filtering for ranges above 0
-violin__dot_df = df[df['Electric Range'] > 0]
-
-## creating jitter
-cats = violin__dot_df['Electric Vehicle Type'].astype('category').cat.categories
-
-violin__dot_df['Electric Vehicle Type Code'] = violin__dot_df['Electric Vehicle Type'].astype('category').cat.codes
-
-violin__dot_df['Jitter'] = violin__dot_df['Electric Vehicle Type Code'] + np.random.normal(0, 0.05, len(violin__dot_df))
+## Filtering for ranges above 0 and creating the jitter both happen in `prepare_dashboard_data`
+violin__dot_df = dashboard['violin__dot_df']
+cats = dashboard['cats']
 
 
 # Below is the creation of the function to create my jittered dot plot. As you can see, hvplot only has the ability to create a scatter plot, but the variables used in this plot are what make it turn into a dot plot for our two categories of choice (looking at the relationship between range and EV type). Are minimum and maximum y values were set at 5 less and more than what they actually minimum and maximum were just for visibility and so the data does not show as cut off at the axes. Again, we are filtering here based on our widget select dropdown selection of `EV Regional Origin`. We plot our `Jitter` on the X axis and have the data points grouped by the EV type. To ensure the X axis is labeled correctly. I used list comprehension on the `cats` variable above to label the x axis appropriately. 
+# 
+# When every vehicle is drawn as its own dot, each change of the dropdown sends every single one of them to the browser, which for the 'All' selection adds up to a lot of data. So when a selection has more than `DOT_PLOT_RAW_POINT_LIMIT` vehicles, the dots are counted into a grid of `DOT_PLOT_PIXELS` on the server instead (see `density_grid` in `ev_aggregates.py`) and drawn as an image, where the darker the pixel the more vehicles it holds. That way the size of what is sent depends on the number of pixels, not the number of vehicles. Any pixel with fewer than `DOT_PLOT_OUTLIER_COUNT` vehicles still shows them as individual dots, so the outliers do not disappear. Zooming in rebuilds the grid for the part of the plot in view, and once only a few vehicles are left in view they are drawn as regular dots again. Setting `DOT_PLOT_RASTERIZE` to `False` always draws every dot like before.
 
 # In[8]:
 
 
 miny = -5
-maxy = violin__dot_df['Electric Range'].max() + 5
 
+DOT_PLOT_RASTERIZE = True
+DOT_PLOT_RAW_POINT_LIMIT = 5000
+DOT_PLOT_PIXELS = (200, 300)
+DOT_PLOT_OUTLIER_COUNT = 3
+
+def create_dot_scatter(dot_df):
+    return dot_df.hvplot.scatter(x='Jitter', y='Electric Range', by='Electric Vehicle Type', legend=False)
+
+
+def dot_plot_ranges():
+    ## The full x and y ranges of the dot plot, one slot per EV type across and a little room above the longest range
+    return (-0.5, len(dashboard['cats']) - 0.5), (miny, dashboard['max_range'] + 5)
+
+
+def create_dot_raster(dot_df, x_range=None, y_range=None):
+    x_range = x_range or dot_plot_ranges()[0]
+    y_range = y_range or dot_plot_ranges()[1]
+
+    with phase('data_prep'):
+        ## Zoomed in far enough that only a few vehicles are in view, so just draw those as regular dots
+        in_view = dot_df[dot_df['Jitter'].between(*x_range) & dot_df['Electric Range'].between(*y_range)]
+        if len(in_view) <= DOT_PLOT_RAW_POINT_LIMIT:
+            counts, sparse = np.zeros((1, 1)), np.ones(len(in_view), dtype=bool)
+        else:
+            counts, sparse = density_grid(in_view['Jitter'], in_view['Electric Range'], x_range, y_range,
+                                          *DOT_PLOT_PIXELS, min_count=DOT_PLOT_OUTLIER_COUNT)
+
+    with plot_build():
+        ## Empty pixels are left see-through, and the nearly empty ones show their vehicles as dots on top of the image
+        density = hv.Image(np.where(counts > 0, counts, np.nan).astype(np.float32), bounds=(x_range[0], y_range[0], x_range[1], y_range[1]),
+                           kdims=['Jitter', 'Electric Range'], vdims=['Number of EVs']).opts(
+                               cmap='BuPu', logz=True, colorbar=True, tools=['hover'], clim=(1, max(counts.max(), 2)))
+
+        return (density * create_dot_scatter(in_view[sparse])).opts(**dot_plot_opts())
+
+
+def dot_plot_rows(ev_origin):
+    violin__dot_df = dashboard['violin__dot_df']
+    return violin__dot_df[violin__dot_df['EV Regional Origin'] == ev_origin] if ev_origin != 'All' else violin__dot_df
+
+
+def dot_plot_opts():
+    return dict(
+        width=600, height=600,
+        xticks = [(i, cat) for i, cat in enumerate(dashboard['cats'])],
+        xlabel = 'Electric Vehicle Type',
+        ylabel = 'Electric Range (mi)',
+        title='Range Comparison for Battery Electric and Plug-in Hybrid Vehicles',
+        ylim=dot_plot_ranges()[1]
+    )
+
+
+@cached
+def create_dot_points(ev_origin):
+    with phase('data_prep'):
+        dot_df = dot_plot_rows(ev_origin)
+    with plot_build():
+        return create_dot_scatter(dot_df).opts(**dot_plot_opts())
+
+
+@cached
+def create_dot_overview(ev_origin):
+    return create_dot_raster(dot_plot_rows(ev_origin))
+
+
+## The density image is rebuilt every time the plot is zoomed, outside of `create_dot_plot`, so it is timed on its own
+@timed_callback
+def create_dot_layer(ev_origin, x_range=None, y_range=None):
+    ## Only the un-zoomed image goes into the shared cache. Every zoom or pan has ranges of its own, which would soon push
+    ## the plots every session asks for out of the cache
+    if x_range is None and y_range is None:
+        return create_dot_overview(ev_origin)
+    return create_dot_raster(dot_plot_rows(ev_origin), x_range, y_range)
+
+
+@timed_callback
 def create_dot_plot(ev_origin):
-    first_filter_dot_plot = violin__dot_df[violin__dot_df['EV Regional Origin'] == ev_origin] if ev_origin != 'All' else violin__dot_df
-
-    return first_filter_dot_plot.hvplot.scatter(x='Jitter', y='Electric Range', by='Electric Vehicle Type',
-                                            width=600, height=600, legend=False).opts(
-                                            xticks = [(i, cat) for i, cat in enumerate(cats)],
-                                            xlabel = 'Electric Vehicle Type',
-                                            ylabel = 'Electric Range (mi)',
-                                            title='Range Comparison for Battery Electric and Plug-in Hybrid Vehicles'
-                                            ).opts(
-                                                ylim=(miny, maxy)
-                                            )
+    ## `dot_plot_sizes` has how many vehicles are behind each dropdown choice, so deciding between dots and the density image does not need the rows
+    if DOT_PLOT_RASTERIZE and dashboard['dot_plot_sizes'].get(ev_origin, 0) > DOT_PLOT_RAW_POINT_LIMIT:
+        ## RangeXY sends the visible x and y ranges back every time the plot is zoomed or panned, so the image is rebuilt for the new view.
+        ## Every session gets its own DynamicMap since zooming happens per browser, but the images behind it come from the shared cache
+        ## The un-zoomed image is built here, where this runs off the event loop, so drawing the DynamicMap on the loop
+        ## only has to take it from the cache
+        create_dot_overview(ev_origin)
+        with plot_build():
+            return hv.DynamicMap(lambda x_range, y_range: create_dot_layer(ev_origin, x_range, y_range),
+                                 streams=[hv.streams.RangeXY()]).opts(**dot_plot_opts())
+
+    return create_dot_points(ev_origin)
 
 
 # ### Heatmap
@@ -265,11 +368,8 @@ def create_dot_plot(ev_origin):
 # In[9]:
 
 
-df_wa_counties = df[df['State'] == 'WA']
-df_top_10_counties_ev_wa = df_wa_counties.groupby('County').agg({'VIN (1-10)':'count'}).nlargest(10, 'VIN (1-10)')
-df_top_10_counties_ev_wa = df_top_10_counties_ev_wa.reset_index(inplace=False)
-
-df_wa_counties_new = df_wa_counties[df_wa_counties['County'].isin(df_top_10_counties_ev_wa['County'])]
+## The top 10 WA counties by number of EVs, worked out once in `prepare_dashboard_data`
+df_top_10_counties_ev_wa = dashboard['df_top_10_counties_ev_wa']
 
 
 # To create the heatmap, I first needed to generate a pivot table. To do this, I used the built in Pandas function `pivot_table`. I wanted to aggregate a count of all the vehicles in a county based on their regional origin. Any Nan values were filled in with zeroes so as to avoid errors in processing and plotting the data. 
@@ -283,39 +383,48 @@ df_wa_counties_new = df_wa_counties[df_wa_counties['County'].isin(df_top_10_coun
 # In[10]:
 
 
-def create_heatmap(year_range):
-    filtered_df_wa_counties = df_wa_counties_new[(df_wa_counties_new['Model Year'] >= year_range[0]) & (df_wa_counties_new['Model Year'] <= year_range[1])]
-   
+custom_ticks = [1000, 5000, 25000, 70000]
+custom_tick_code = """
+    var log = Math.log10(tick);
+    return tick.toLocaleString() + " (log₁₀=" + log.toFixed(1) + ")";
+    """
 
-    heat_map_data = filtered_df_wa_counties.pivot_table(index="County", columns="EV Regional Origin", values='VIN (1-10)', aggfunc='count', fill_value=0, sort=False)
+def heatmap_colorbar_hook(plot, element):
+    ## Bokeh models can only belong to one page, and the heatmap itself is shared through the cache,
+    ## so the ticker and formatter are made fresh every time the heatmap is drawn
+    fixed_ticker = FixedTicker(ticks=custom_ticks)
 
-    heat_map_long = heat_map_data.reset_index().melt(
-    id_vars='County',
-    var_name='EV Regional Origin',
-    value_name='Number of EVs Registered'
-    )
+    custom_formatter_2 = CustomJSTickFormatter(code=custom_tick_code)
 
-    custom_ticks = [1000, 5000, 25000, 70000]
+    plot.handles['colorbar'].ticker = fixed_ticker
+    plot.handles['colorbar'].formatter = custom_formatter_2
 
-    fixed_ticker = FixedTicker(ticks=custom_ticks)
 
-    custom_formatter_2 = CustomJSTickFormatter(code="""
-    var log = Math.log10(tick);
-    return tick.toLocaleString() + " (log₁₀=" + log.toFixed(1) + ")";
-    """)
-
-    return heat_map_long.hvplot.heatmap(x='EV Regional Origin', 
-                                        y='County', 
-                                        C='Number of EVs Registered', 
-                                        cmap='BuPu', 
-                                        xlabel='EV Car Model Origin', 
-                                        ylabel='Washington State County', 
-                                        title='Top 10 WA Counties: EVs Registered by Car Origin (Log Scale)',
-                                        logz=True,
-                                        colorbar=True).opts(
-                                            colorbar_opts={'title': 'Raw Number of EVs (w/ Log Scale)', 'ticker': fixed_ticker, 'formatter': custom_formatter_2}
-                                            
-                                        )
+@timed_callback
+@cached
+def create_heatmap(year_range):
+    with phase('data_prep'):
+        heat_map_data = cube_county_origin_counts(dashboard['ev_count_cube'], year_range, dashboard['df_top_10_counties_ev_wa']['County'])
+
+        heat_map_long = heat_map_data.reset_index().melt(
+        id_vars='County',
+        var_name='EV Regional Origin',
+        value_name='Number of EVs Registered'
+        )
+
+    with plot_build():
+        return heat_map_long.hvplot.heatmap(x='EV Regional Origin', 
+                                            y='County', 
+                                            C='Number of EVs Registered', 
+                                            cmap='BuPu', 
+                                            xlabel='EV Car Model Origin', 
+                                            ylabel='Washington State County', 
+                                            title='Top 10 WA Counties: EVs Registered by Car Origin (Log Scale)',
+                                            logz=True,
+                                            colorbar=True).opts(
+                                                colorbar_opts={'title': 'Raw Number of EVs (w/ Log Scale)'},
+                                                hooks=[heatmap_colorbar_hook]
+                                            )
     
 
 
@@ -334,56 +443,216 @@ def create_heatmap(year_range):
 # In[11]:
 
 
+## Electric range counts per model year and origin, with a cumulative sum along the years (see `ev_aggregates.py`)
+range_histograms = dashboard['range_histograms']
+## Every origin keeps the colour hvplot gave it, and any other (e.g. 'Unknown') is grey
+violin_colors = {'Asia': 'red', 'Europe': 'silver', 'North America': 'blue'}
+violin_width = 0.8
+
+@timed_callback
+@cached
 def create_violin_plot(year_range):
+    with phase('data_prep'):
+        range_histograms = dashboard['range_histograms']
+        violins = histogram_violins(range_histograms, year_range)
+
+        outlines, whiskers, boxes, medians = [], [], [], []
+        for i, origin in enumerate(range_histograms['origins']):
+            if origin not in violins:
+                continue
+            violin = violins[origin]
+            ## An origin whose vehicles all have the same range gets no outline, only its box and median
+            if violin['density'] is not None:
+                half_width = violin['density'] / violin['density'].max() * violin_width / 2
+                outlines.append({
+                    'x': np.concatenate([i - half_width, (i + half_width)[::-1]]),
+                    'y': np.concatenate([violin['support'], violin['support'][::-1]]),
+                    'EV Regional Origin': origin,
+                    'color': violin_colors.get(origin, 'grey'),
+                })
+            whiskers.append((i, violin['lower'], i, violin['upper']))
+            boxes.append((i - 0.05, violin['q1'], i + 0.05, violin['q3']))
+            medians.append((i, violin['q2']))
+
+    with plot_build():
+        return (
+            hv.Polygons(outlines, vdims=['EV Regional Origin', 'color']).opts(color='color', line_color='black', tools=['hover'])
+            * hv.Segments(whiskers, kdims=['x0', 'y0', 'x1', 'y1']).opts(color='black')
+            * hv.Rectangles(boxes).opts(color='black')
+            * hv.Points(medians).opts(color='white', size=5)
+        ).opts(
+            width=600, height=600,
+            xticks=[(i, origin) for i, origin in enumerate(range_histograms['origins'])],
+            xlim=(-0.5, len(range_histograms['origins']) - 0.5),
+            xlabel='EV Regional Origin',
+            ylabel='Electric Range (mi)',
+            ylim=(-25, 400),
+            title='Distribution of Electric Range Distances Grouped by EV Origin Region'
+        )
+
+
+## Uncomment to check how far the violins drawn from the histograms are from the KDE worked out on every vehicle
+# violin_accuracy(violin__dot_df, range_histograms, (df['Model Year'].min(), df['Model Year'].max()))
+
 
-    filtered_violin_df = violin__dot_df[(violin__dot_df['Model Year'] >= year_range[0]) & (violin__dot_df['Model Year'] <= year_range[1])]
+# As you can see, I did the same `year_range` filtering as the heatmap above before retuning the plot. Also of note, I used the same dataframe, `violin__dot_df`, as above which has only rows where the electric range is above 0. 
+# 
+# Originally the filtered rows were handed to `hvplot.violin`, which worked out the shape of every violin from every single vehicle each time the slider moved. Now the electric ranges are counted into 1 mile bins per model year and origin once (`build_range_histograms`), and a `year_range` just adds up the bins for those years. The violin outline is the same kind of KDE hvplot draws, only computed from the bins, and the box in the middle shows the quartiles and whiskers worked out from the same bins. So the work done on each slider move depends on the number of bins rather than the number of vehicles. `violin_accuracy` compares the result against the KDE worked out from the raw rows.
 
-    return filtered_violin_df.hvplot.violin(y='Electric Range', by='EV Regional Origin', ylabel='Electric Range (mi)',
-                 cmap=['red', 'silver', 'blue'], legend=False, color='EV Regional Origin',
-                 width=600, height=600, padding=0.4).opts(
-                     ylim=(-25, 400),
-                     title='Distribution of Electric Range Distances Grouped by EV Origin Region'
-                 )
+# ## Map
 
+# The dataset also has the `Vehicle Location` of every vehicle, as text like `POINT (-122.30 47.60)`, so I wanted to see where in Washington the EVs actually are, and how that changes with the origin and the model years. Drawing hundreds of thousands of points on a map every time a widget changes would be slow, so I did the same thing as for the bar plot and heatmap. The locations are parsed once, with every distinct location string read in one go by pandas instead of one row at a time, and the vehicles are counted into 2 km squares per model year and origin (`build_location_bins` in `ev_aggregates.py`). Each square is then coloured by how many vehicles are in it, on a log scale since the Seattle area has far more EVs than the rest of the state. Changing the dropdown or the slider only subtracts two slices of those counts, which takes a few milliseconds for the whole state.
+
+# In[ ]:
+
+
+@timed_callback
+@cached
+def create_map(ev_origin, year_range):
+    with phase('data_prep'):
+        location_bins = dashboard['location_bins']
+        counts = location_bin_counts(location_bins, year_range, ev_origin)
+        image, bounds = location_grid(location_bins, counts)
+        ## An origin can have no vehicles at all in the chosen years, and a log colour scale has no range to work out
+        ## from an image that is empty everywhere, so the range is always given
+        most = counts.max() if len(counts) else 0
+
+    with plot_build():
+        return hv.element.tiles.CartoLight() * hv.Image(image, bounds=bounds, vdims=['Number of EVs']).opts(
+            cmap='BuPu',
+            logz=True,
+            colorbar=True,
+            alpha=0.8,
+            tools=['hover'],
+            clipping_colors={'NaN': (0, 0, 0, 0)},
+            clim=(1, max(most, 2)),
+            data_aspect=1,
+            frame_height=500,
+            xaxis=None,
+            yaxis=None,
+            title='EVs Registered in WA by Location ({} Origin, {}-{})'.format(ev_origin, *year_range)
+        )
 
-# As you can see, I did the same `year_range` filtering as the heatmap above before retuning the plot. Also of note, I used the same dataframe, `violin__dot_df`, as above which has only rows where the electric range is above 0. 
 
 # ## Dashboard
 
 # <ins>Widgets</ins>
 # 
-# I wanted to include two widgets to help make the plots more interactive. The widgets control multiple plots, with the select dropdown updating the bar and jittered dot plot, while the rangle slider controls the heatmap and violin plot. They were created using widgets from the Panel library. You can see the customization in the parameters passed in below
+# I wanted to include two widgets to help make the plots more interactive. The widgets control multiple plots, with the select dropdown updating the bar and jittered dot plot, while the rangle slider controls the heatmap and violin plot. The map at the bottom follows both of them. They were created using widgets from the Panel library. You can see the customization in the parameters passed in below
 
 # In[12]:
 
 
 select_var_ev_origin = pn.widgets.Select(
-    options=[x for x in df['EV Regional Origin'].unique()] + ['All'],                   
+    options=[x for x in dashboard['origins']] + ['All'],                   
     value='All',                   
     description='Choose which Regional HQ Location You would like to focus on'
 )
 
 
 year_range_slider = pn.widgets.RangeSlider(
-    start=df['Model Year'].min(),
-    end=df['Model Year'].max(),
-    value=(df['Model Year'].min(), df['Model Year'].max()),
+    start=ev_count_cube['years'][0],
+    end=ev_count_cube['years'][-1],
+    value=(ev_count_cube['years'][0], ev_count_cube['years'][-1]),
     step=1
 )
 
 
 # From here, we need to bind these widgets to our respective plots. Again, we can use Panel to facilitate this for us by using the pn.bind function and passing in our function that returns our respective plot, and the widget we want tied to that plot. Notice how we have to match the parameter to the parameter that is declared in each `create_plot` function. This is so each function can properly get the values from the wdiget passed into it from our interaction. Ex: `pn.bind(create_barplot, ev_origin=select_var_ev_origin)` contains `ev_origin` and the `create_barplot` function has the same parameter name.
+# 
+# The plot functions are also wrapped with `@cached` (see `ev_cache.py`). Every browser session that opens the dashboard gets its own run of this script, but the cache lives in a module that is shared by the whole server process. So once any visitor has seen, say, the 'All' bar plot or the full year range heatmap, every other visitor gets that same plot straight from the cache instead of it being built again. `cache_stats()` shows how many hits, misses and evictions each plot function has had.
+# 
+# With `CONCURRENT_CALLBACKS` on, each plot function is wrapped with `in_background` (see `ev_callbacks.py`), so it runs in a pool of worker threads instead of on the session's event loop. The data for the two plots tied to the same widget is worked out at the same time (HoloViews itself only builds one plot at a time, since its options store is not thread safe), the page keeps responding while they are built (with a loading spinner over the plot), and a plot that is still waiting when a newer widget value comes in is cancelled. The heatmap and violin plot are also bound to `value_throttled` instead of `value`, which only changes once the slider handle is released, so dragging the slider no longer rebuilds both plots for every year it passes through.
+# 
+# With `DEFER_PLOTS` on, the page goes out to the browser as soon as the widgets are made, with a loading spinner in place of every plot, and the plots are only built once the page has loaded. On a server that was asleep, that means the page shows up without waiting for the plots (or for hvplot to finish importing).
+# 
+# With `CLIENT_SIDE_FILTERING` on, none of that happens on the server at all. The counts and the vehicles the plots are made from are sent to the browser once with the page, and the plots are filtered and added up again in JavaScript whenever a widget changes (see `ev_client.py`). The first page load is bigger, since it carries every vehicle, but after that changing the dropdown or the slider does not need the server. The map is left out in this mode, since the vehicle counts per location only live on the server.
 
 # In[13]:
 
 
-interactive_bar_plot = pn.bind(create_barplot, ev_origin=select_var_ev_origin)
-interactive_dot = pn.bind(create_dot_plot, ev_origin=select_var_ev_origin)
-interactive_heatmap = pn.bind(create_heatmap, year_range=year_range_slider)
-interactive_violin = pn.bind(create_violin_plot, year_range=year_range_slider)
+## Set to False to go back to building every plot on the event loop for every value the slider passes through
+CONCURRENT_CALLBACKS = True
+## Set to True to send the data to the browser once and do all the filtering there
+CLIENT_SIDE_FILTERING = False
+## Set to False to build the first plots before the page is sent, instead of once it has loaded
+DEFER_PLOTS = True
+
+## The time until the first session's plots are built is kept next to the other startup steps (see `ev_metrics.py`)
+if not CLIENT_SIDE_FILTERING:
+    time_first_plots(started, ['create_barplot', 'create_dot_plot', 'create_heatmap', 'create_violin_plot', 'create_map'])
+
+if CLIENT_SIDE_FILTERING:
+    client_plots = ClientSidePlots(dashboard, select_var_ev_origin, year_range_slider, dot_plot_ranges, custom_ticks, custom_tick_code)
+    interactive_bar_plot, interactive_dot, interactive_heatmap, interactive_violin = (pn.pane.Bokeh(plot) for plot in client_plots.plots)
+    ## The counts per location are far too many to send to the browser, and a map drawn on the server would need the server
+    ## for every widget change again, so there is no map in this mode
+    interactive_map = None
+elif CONCURRENT_CALLBACKS:
+    interactive_bar_plot = pn.panel(pn.bind(in_background(create_barplot), ev_origin=select_var_ev_origin), loading_indicator=True, defer_load=DEFER_PLOTS)
+    interactive_dot = pn.panel(pn.bind(in_background(create_dot_plot), ev_origin=select_var_ev_origin), loading_indicator=True, defer_load=DEFER_PLOTS)
+    interactive_heatmap = pn.panel(pn.bind(in_background(create_heatmap), year_range=year_range_slider.param.value_throttled), loading_indicator=True, defer_load=DEFER_PLOTS)
+    interactive_violin = pn.panel(pn.bind(in_background(create_violin_plot), year_range=year_range_slider.param.value_throttled), loading_indicator=True, defer_load=DEFER_PLOTS)
+    interactive_map = pn.panel(pn.bind(in_background(create_map), ev_origin=select_var_ev_origin, year_range=year_range_slider.param.value_throttled), loading_indicator=True, defer_load=DEFER_PLOTS)
+else:
+    interactive_bar_plot = pn.panel(pn.bind(create_barplot, ev_origin=select_var_ev_origin), defer_load=DEFER_PLOTS)
+    interactive_dot = pn.panel(pn.bind(create_dot_plot, ev_origin=select_var_ev_origin), defer_load=DEFER_PLOTS)
+    interactive_heatmap = pn.panel(pn.bind(create_heatmap, year_range=year_range_slider), defer_load=DEFER_PLOTS)
+    interactive_violin = pn.panel(pn.bind(create_violin_plot, year_range=year_range_slider), defer_load=DEFER_PLOTS)
+    interactive_map = pn.panel(pn.bind(create_map, ev_origin=select_var_ev_origin, year_range=year_range_slider), defer_load=DEFER_PLOTS)
+
+
+# The DOL puts out a new version of this dataset every month. Instead of restarting the server to pick it up, each server process checks the csv in the background (`start_refresh_watcher`) and, when it has changed, only applies the vehicles that were added, changed or deregistered to the shared data (see `ev_refresh.py`). Every open dashboard checks every few seconds whether the data it is showing is still the latest, and if not, it sends its current widget values again so all the plots get rebuilt from the new data (or, with `CLIENT_SIDE_FILTERING`, sends the browser the new data to filter), without anyone having to reload the page.
+
+# In[ ]:
+
+
+## How often (in seconds) the server looks for a new csv, and how often (in milliseconds) an open dashboard checks for new data
+DATA_REFRESH_INTERVAL = 15 * 60
+SESSION_REFRESH_CHECK = 10 * 1000
+
+start_refresh_watcher(DATA_REFRESH_INTERVAL)
+shown_version = dashboard['version']
+
+def redraw_if_refreshed():
+    global shown_version
+    if dashboard['version'] == shown_version:
+        return
+    shown_version = dashboard['version']
+
+    ## A new model year or origin can show up in an update, so the widgets get the new choices first
+    years = dashboard['ev_count_cube']['years']
+    select_var_ev_origin.options = [x for x in dashboard['origins']] + ['All']
+    year_range_slider.param.update(start=years[0], end=years[-1])
+
+    if CLIENT_SIDE_FILTERING:
+        ## The new data goes into the sources the browser filters, the plots themselves stay
+        client_plots.update(dashboard)
+        return
+
+    select_var_ev_origin.param.trigger('value')
+    year_range_slider.param.trigger('value', 'value_throttled')
+
+## Only runs once the page has loaded in a browser, so nothing is checked while this runs as a notebook
+pn.state.onload(lambda: pn.state.add_periodic_callback(redraw_if_refreshed, period=SESSION_REFRESH_CHECK))
+
+
+# To find out where the time goes once the dashboard is deployed, every plot function is wrapped with `@timed_callback` and split into its `data_prep` and `plot_build` parts, and the time Panel and Bokeh then take to turn the plot into an update for the browser is measured as well (see `ev_metrics.py`). Those timings, the size of every update, the number of open sessions and the plot cache counters are served as histograms on a small metrics page next to the dashboard. The profiler is off unless `PROFILE_SLOWER_THAN` is set.
+
+# In[ ]:
+
+
+## Latency and payload histograms are served at http://127.0.0.1:9464/metrics (the next free port for every further server process)
+METRICS_PORT = 9464
+## Any callback slower than this many seconds leaves a cProfile dump in ./profiles/, None leaves the profiler off
+PROFILE_SLOWER_THAN = None
+
+start_metrics_server(METRICS_PORT)
+set_profile_threshold(PROFILE_SLOWER_THAN)
+track_session()
 
 
-# Lets finally create our dashboard using our variables assigned above. We can use panel to create rows and column for our dashboard and nest them inside each other. Since in this case, I had 4 plots, and 2 widgets that controled 2 plots each, I wanted to keep the plots controlled by the same widget in the same row. The widget would then be in the row right above it, so as to signal that this particular widget controls these 2 plots, and so on. 
+# Lets finally create our dashboard using our variables assigned above. We can use panel to create rows and column for our dashboard and nest them inside each other. Since in this case, I had 4 plots, and 2 widgets that controled 2 plots each, I wanted to keep the plots controlled by the same widget in the same row. The widget would then be in the row right above it, so as to signal that this particular widget controls these 2 plots, and so on. The map, which both widgets control, goes in its own row at the bottom. 
 # 
 # To run the dashboard locally, you could uncomment the line `dashboard_final.servable()` below and take it for a spin! Don't forget it is also available on the cloud at: [HuggingFace](https://huggingface.co/spaces/ccthatsme/521_assignment3)
 
@@ -397,10 +666,15 @@ dashboard_final = pn.Column(
     pn.Row(interactive_bar_plot, interactive_dot),
     pn.pane.Markdown("<h3 style='font-size:1.5em; color: black'>Use the following slider to filter for EV Model Years in the 2 plots below</h3>"),
     pn.Row(year_range_slider),
-    pn.Row(interactive_heatmap, interactive_violin)
+    pn.Row(interactive_heatmap, interactive_violin),
+    *([] if interactive_map is None else [
+        pn.pane.Markdown("<h3 style='font-size:1.5em; color: black'>The map below follows both the dropdown and the slider</h3>"),
+        pn.Row(interactive_map)
+    ])
 )
 
 dashboard_final.servable()
+record_startup('page', time.perf_counter() - started)
 
 
 # In[15]: